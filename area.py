@@ -0,0 +1,295 @@
+# -*- coding:utf-8 -*-
+"""
+地区id索引
+把 area_id/*.txt 编译为一个紧凑的二进制索引文件，查询时通过 mmap 直接读取，不需要把全部省份加载为字典
+
+python area.py --build                 # 重新生成索引（索引不存在或早于 txt 文件时会自动生成）
+python area.py 1_72_2799               # id -> 北京-朝阳区-三环以内
+python area.py 北京-朝阳区-三环以内      # 名称 -> 1_72_2799，可以只写后几级，如 朝阳区-三环以内
+python area.py --prefix 三环           # 名称前缀搜索
+python area.py --search 朝阳           # 名称包含关键字的地区
+"""
+import argparse
+import ast
+import bisect
+import glob
+import mmap
+import os
+import re
+import struct
+
+AREA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'area_id')
+INDEX_FILE = os.path.join(AREA_DIR, 'area.idx')
+
+# 索引格式或名称处理方式变化时修改，旧的索引文件会自动重新生成
+MAGIC = b'JDAREA02'
+# magic, 节点数, 省份数, 节点表偏移, 名称排序表偏移, 名称区偏移
+HEADER = struct.Struct('<8sIIIII')
+# 地区id, 父节点序号(-1 为省份), 第一个子节点序号, 名称偏移, 名称字节数, 子节点数
+NODE = struct.Struct('<iiIIHH')
+INDEX = struct.Struct('<I')
+
+KEY_PATTERN = re.compile(r'^(.*)\((\d+)\)$')
+
+
+def load_source(area_dir=AREA_DIR):
+    """读取 txt 文件，返回 [(名称, id, 子节点列表)]"""
+    def convert(tree):
+        nodes = []
+        for key, value in tree.items():
+            match = KEY_PATTERN.match(key.strip())
+            if match is None:
+                raise ValueError('无法解析地区名称: {}'.format(key))
+            children = convert(value) if isinstance(value, dict) else []
+            # 部分名称末尾带有全角空格（如 '萨迦县\u3000'），去掉后才能按名称查询
+            nodes.append((match.group(1).strip(), int(match.group(2)), children))
+        return nodes
+
+    provinces = []
+    for path in glob.glob(os.path.join(area_dir, '*.txt')):
+        with open(path, encoding='utf-8') as f:
+            provinces.extend(convert(ast.literal_eval(f.read())))
+    return provinces
+
+
+def build_index(area_dir=AREA_DIR, output=INDEX_FILE):
+    """生成索引文件：同一父节点的子节点连续存放并按 id 排序，便于按 id 逐级二分查找"""
+    nodes = []
+    provinces = sorted(load_source(area_dir), key=lambda x: x[1])
+    level = [(-1, provinces)]
+    # 按层序编号，保证每个节点的子节点序号连续
+    while level:
+        next_level = []
+        for parent, children in level:
+            first = len(nodes)
+            if parent >= 0:
+                nodes[parent][2] = first
+                nodes[parent][4] = len(children)
+            for name, area_id, grandchildren in children:
+                nodes.append([area_id, parent, 0, name.encode('utf-8'), 0])
+                next_level.append((len(nodes) - 1, sorted(grandchildren, key=lambda x: x[1])))
+        level = [item for item in next_level if item[1]]
+
+    names = bytearray()
+    table = bytearray()
+    for area_id, parent, first_child, name, child_count in nodes:
+        table += NODE.pack(area_id, parent, first_child, len(names), len(name), child_count)
+        names += name
+    order = sorted(range(len(nodes)), key=lambda i: nodes[i][3])
+    name_order = b''.join(INDEX.pack(i) for i in order)
+
+    nodes_offset = HEADER.size
+    order_offset = nodes_offset + len(table)
+    names_offset = order_offset + len(name_order)
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(nodes), len(provinces), nodes_offset, order_offset, names_offset))
+        f.write(table)
+        f.write(name_order)
+        f.write(names)
+    os.replace(tmp_path, output)
+    return len(nodes)
+
+
+def index_stale(area_dir=AREA_DIR, index=INDEX_FILE):
+    if not os.path.exists(index):
+        return True
+    with open(index, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return True
+    built = os.path.getmtime(index)
+    return any(os.path.getmtime(path) > built for path in glob.glob(os.path.join(area_dir, '*.txt')))
+
+
+class AreaIndex(object):
+    """地区id索引查询
+
+    节点按序号定长存放，id 查询沿路径在子节点范围内二分查找；
+    名称查询在按名称排序的序号表上二分查找，关键字搜索直接在名称区中查找子串。
+    """
+
+    def __init__(self, path=INDEX_FILE, area_dir=AREA_DIR):
+        if path == INDEX_FILE and index_stale(area_dir, path):
+            build_index(area_dir, path)
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, self.provinces, self.nodes_offset, self.order_offset,
+         self.names_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError('地区索引文件格式错误: {}'.format(path))
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def node(self, i):
+        return NODE.unpack_from(self.mm, self.nodes_offset + i * NODE.size)
+
+    def name_bytes(self, i):
+        _, _, _, offset, length, _ = self.node(i)
+        start = self.names_offset + offset
+        return self.mm[start:start + length]
+
+    def name(self, i):
+        return self.name_bytes(i).decode('utf-8')
+
+    def ancestors(self, i):
+        """从省份到节点自身的序号列表"""
+        path = []
+        while i >= 0:
+            path.append(i)
+            i = self.node(i)[1]
+        return path[::-1]
+
+    def area_id(self, i):
+        return '_'.join(str(self.node(j)[0]) for j in self.ancestors(i))
+
+    def full_name(self, i, sep='-'):
+        return sep.join(self.name(j) for j in self.ancestors(i))
+
+    def find_id(self, area_id):
+        """按 id 查找节点序号，支持 _ 或 - 分隔，末尾补齐的 0 会被忽略"""
+        parts = [int(part) for part in re.split('[_-]', area_id.strip()) if part.strip()]
+        while parts and parts[-1] == 0:
+            parts.pop()
+        if not parts:
+            return None
+        low, high = 0, self.provinces
+        node = None
+        for part in parts:
+            ids = _Field(self, 0, low)
+            pos = bisect.bisect_left(ids, part, 0, high - low)
+            if pos == high - low or ids[pos] != part:
+                return None
+            node = low + pos
+            _, _, first_child, _, _, child_count = self.node(node)
+            low, high = first_child, first_child + child_count
+        return node
+
+    def lookup_id(self, area_id):
+        """1_72_2799 -> 北京-朝阳区-三环以内，不存在时返回 None"""
+        node = self.find_id(area_id)
+        return None if node is None else self.full_name(node)
+
+    def find_name(self, name):
+        """名称完全相同的全部节点序号"""
+        key = name.encode('utf-8')
+        names = _Names(self)
+        pos = bisect.bisect_left(names, key)
+        result = []
+        while pos < self.count and names[pos] == key:
+            result.append(names.node(pos))
+            pos += 1
+        return result
+
+    def lookup_name(self, query):
+        """北京-朝阳区-三环以内 -> ['1_72_2799']
+        可以只写最后几级，每一级必须与上一级直接相连
+        """
+        parts = [part.strip() for part in re.split('[-_/ ]', query) if part.strip()]
+        if not parts:
+            return []
+        result = []
+        for node in self.find_name(parts[-1]):
+            path = self.ancestors(node)
+            if len(path) >= len(parts) and all(
+                    self.name(j) == part for j, part in zip(path[len(path) - len(parts):], parts)):
+                result.append(self.area_id(node))
+        return result
+
+    def prefix(self, prefix, limit=20):
+        """名称以 prefix 开头的地区：[(id, 完整名称)]"""
+        key = prefix.encode('utf-8')
+        names = _Names(self)
+        pos = bisect.bisect_left(names, key)
+        result = []
+        while pos < self.count and len(result) < limit and names[pos].startswith(key):
+            node = names.node(pos)
+            result.append((self.area_id(node), self.full_name(node)))
+            pos += 1
+        return result
+
+    def search(self, keyword, limit=20):
+        """名称中包含 keyword 的地区：[(id, 完整名称)]"""
+        key = keyword.encode('utf-8')
+        offsets = _Field(self, 3, 0)
+        result = []
+        start = self.names_offset
+        while len(result) < limit:
+            found = self.mm.find(key, start)
+            if found < 0:
+                break
+            # 名称区按节点序号依次存放，由偏移二分得到所在节点
+            node = bisect.bisect_right(offsets, found - self.names_offset, 0, self.count) - 1
+            _, _, _, offset, length, _ = self.node(node)
+            if found + len(key) <= self.names_offset + offset + length:
+                result.append((self.area_id(node), self.full_name(node)))
+                start = self.names_offset + offset + length
+            else:
+                # 跨越了两个名称的匹配，从下一个字节继续
+                start = found + 1
+        return result
+
+
+class _Field(object):
+    """节点表某一列的只读序列视图，供 bisect 使用"""
+
+    def __init__(self, index, column, base):
+        self.index = index
+        self.column = column
+        self.base = base
+
+    def __getitem__(self, i):
+        return self.index.node(self.base + i)[self.column]
+
+    def __len__(self):
+        return self.index.count - self.base
+
+
+class _Names(object):
+    """按名称排序的序号表视图"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def node(self, i):
+        return INDEX.unpack_from(self.index.mm, self.index.order_offset + i * INDEX.size)[0]
+
+    def __getitem__(self, i):
+        return self.index.name_bytes(self.node(i))
+
+    def __len__(self):
+        return self.index.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='地区id查询')
+    parser.add_argument('query', nargs='*', help='地区id（如 1_72_2799）或名称（如 北京-朝阳区-三环以内）')
+    parser.add_argument('--build', action='store_true', help='重新生成索引')
+    parser.add_argument('--prefix', help='名称前缀搜索')
+    parser.add_argument('--search', help='名称包含关键字的地区')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.build:
+        print('已生成地区索引，共{}个地区：{}'.format(build_index(), INDEX_FILE))
+
+    with AreaIndex() as index:
+        for query in args.query:
+            if re.fullmatch(r'[\d_\-\s]+', query):
+                print('{} -> {}'.format(query, index.lookup_id(query) or '不存在'))
+            else:
+                print('{} -> {}'.format(query, ', '.join(index.lookup_name(query)) or '不存在'))
+        for keyword, method in ((args.prefix, index.prefix), (args.search, index.search)):
+            if keyword:
+                for area_id, name in method(keyword, args.limit):
+                    print('{:<20}{}'.format(area_id, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,28 @@
 """
 area参数自助生成
 运行脚本，根据提示逐级选择区域即可
+
+python get_area_id.py --crawl                 # 抓取全部地区，重新生成本文件夹中的 txt 文件及地区索引
+python get_area_id.py --crawl --max-age 0     # 忽略缓存有效期，全部向服务器确认是否有变化
+python get_area_id.py --crawl --server http://127.0.0.1:8899 --output /tmp/area   # 对本地模拟服务器抓取
 """
 
+import argparse
 import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
+from requests.adapters import HTTPAdapter
+
+AREA_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(AREA_DIR))
+
+from area import build_index  # noqa: E402
+from variables import DEFAULT_TIMEOUT  # noqa: E402
 
 provinces = [
     {'name': '北京', 'id': 1}, {'name': '上海', 'id': 2}, {'name': '天津', 'id': 3},
@@ -22,17 +39,161 @@ provinces = [
     {'name': '云南', 'id': 25}, {'name': '西藏', 'id': 26}, {'name': '陕西', 'id': 27},
     {'name': '甘肃', 'id': 28}, {'name': '青海', 'id': 29}, {'name': '宁夏', 'id': 30},
     {'name': '新疆', 'id': 31}, {'name': '台湾', 'id': 32}, {'name': '港澳', 'id': 52993},
-    {'name': '钓鱼岛', 'id': 84}
+    {'name': '钓鱼岛', 'id': 84}, {'name': '海外', 'id': 53283}
 ]
 
+AREA_URL = 'https://d.jd.com/area/get'
+
 
 def get_area_by_id(_id):
-    base_uri = 'https://d.jd.com/area/get'
     payload = {'fid': _id}
-    resp = requests.get(url=base_uri, params=payload)
+    resp = requests.get(url=AREA_URL, params=payload, timeout=DEFAULT_TIMEOUT)
     return json.loads(resp.text)
 
 
+class AreaCrawler(object):
+    """并发抓取完整的地区树
+
+    所有请求共用一个带连接池的 session，同时在途的请求数不超过 workers。
+    每个 fid 的返回结果连同 ETag 和抓取时间缓存在 cache_dir 中：
+    未超过 max_age 秒的缓存直接使用，不发送请求；超过的带 If-None-Match 请求，返回 304 时沿用缓存。
+    请求失败时按 backoff 秒起、每次加倍的间隔重试 retries 次，仍然失败时有过期缓存则使用过期缓存，
+    否则记入 failures，不中断整个抓取。
+    """
+
+    def __init__(self, cache_dir, workers=16, max_age=7 * 24 * 3600, server=None, retries=3, backoff=0.5):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_age = max_age
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {'cached': 0, 'not_modified': 0, 'fetched': 0, 'stale': 0}
+        # [(id路径, 错误)]
+        self.failures = []
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        if server:
+            from mock_server import MockAdapter
+            adapter = MockAdapter(server, pool_connections=1, pool_maxsize=workers)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def cache_file(self, fid):
+        return os.path.join(self.cache_dir, '{}.json'.format(fid))
+
+    def load_cache(self, fid):
+        path = self.cache_file(fid)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            # 写入中断等原因损坏的缓存视为不存在
+            return None
+
+    def fetch(self, fid):
+        """获取 fid 的子地区列表 [{'id': ..., 'name': ...}]，请求失败时抛出异常"""
+        cached = self.load_cache(fid)
+        if cached and time.time() - cached['fetched'] < self.max_age:
+            self.count('cached')
+            return cached['data']
+
+        headers = {'If-None-Match': cached['etag']} if cached and cached.get('etag') else None
+        resp = self.session.get(url=AREA_URL, params={'fid': fid}, headers=headers, timeout=DEFAULT_TIMEOUT)
+        if resp.status_code == requests.codes.not_modified and cached:
+            self.count('not_modified')
+            data = cached['data']
+        else:
+            resp.raise_for_status()
+            data = json.loads(resp.text)
+            self.count('fetched')
+
+        path = self.cache_file(fid)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'etag': resp.headers.get('ETag'), 'fetched': time.time(), 'data': data}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return data
+
+    def fetch_with_retry(self, fid, path):
+        """失败时重试，仍然失败返回 None"""
+        for attempt in range(self.retries + 1):
+            try:
+                return self.fetch(fid)
+            except (requests.RequestException, ValueError) as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+
+        cached = self.load_cache(fid)
+        if cached:
+            self.count('stale')
+            return cached['data']
+        with self._lock:
+            self.failures.append((path, error))
+        return None
+
+    def crawl(self, roots):
+        """从 roots 开始逐级抓取，返回 [(名称, id路径, 子节点列表)]，子节点顺序与接口返回一致"""
+        def node(area, parent_path):
+            return area['name'], '{}_{}'.format(parent_path, area['id']) if parent_path else str(area['id']), []
+
+        tree = [node(area, '') for area in roots]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self.fetch_with_retry, int(path), path): (name, path, children)
+                       for name, path, children in tree}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, path, children = pending.pop(future)
+                    for area in future.result() or ():
+                        child = node(area, path)
+                        children.append(child)
+                        pending[executor.submit(self.fetch_with_retry, area['id'], child[1])] = child
+        return tree
+
+
+def format_area_tree(name, path, children, indent=0):
+    """与本文件夹中 txt 文件相同的格式：{'名称(id)': {...}}，没有下级的地区值为 id 路径"""
+    key = repr('{}({})'.format(name, path.rsplit('_', 1)[-1]))
+    if not children:
+        return '{}: {}'.format(key, repr(path))
+    padding = ' ' * 4 * (indent + 1)
+    items = ',\n'.join(padding + format_area_tree(*child, indent=indent + 1) for child in children)
+    return '{}: {{\n{}\n{}}}'.format(key, items, ' ' * 4 * indent)
+
+
+def crawl_all(output=AREA_DIR, workers=16, max_age=7 * 24 * 3600, server=None):
+    crawler = AreaCrawler(os.path.join(output, '.cache'), workers, max_age, server)
+    start = time.time()
+    tree = crawler.crawl(provinces)
+    # 有地区获取失败的省份不完整，保留原来的文件，再次运行时只重新请求失败的部分
+    failed = {path.split('_', 1)[0] for path, _ in crawler.failures}
+    for name, path, children in tree:
+        if path in failed:
+            continue
+        tmp_path = os.path.join(output, '{}.{}.txt.tmp'.format(path, name))
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{{\n    {}\n}}'.format(format_area_tree(name, path, children, indent=1)))
+        os.replace(tmp_path, tmp_path[:-4])
+    count = build_index(output, os.path.join(output, 'area.idx'))
+    print('抓取完成，耗时{:.1f}秒，共{}个地区；使用缓存{}次，未变化{}次，重新获取{}次，获取失败使用过期缓存{}次'.format(
+        time.time() - start, count, crawler.stats['cached'], crawler.stats['not_modified'],
+        crawler.stats['fetched'], crawler.stats['stale']))
+    if crawler.failures:
+        print('以下{}个地区获取失败，所在省份的文件未更新，请稍后重新运行：'.format(len(crawler.failures)))
+        for path, error in sorted(crawler.failures):
+            print('  {}: {}'.format(path, error))
+    return not crawler.failures
+
+
 def print_area(area_list):
     for area in area_list:
         print('【{}】 {}'.format(area['id'], area['name']))
@@ -83,4 +244,14 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='地区id查询与抓取')
+    parser.add_argument('--crawl', action='store_true', help='抓取全部地区并重新生成 txt 文件及索引')
+    parser.add_argument('--output', default=AREA_DIR, help='txt 文件及索引的输出目录')
+    parser.add_argument('--workers', type=int, default=16, help='同时在途的请求数')
+    parser.add_argument('--max-age', type=float, default=7 * 24 * 3600, help='缓存有效期（秒），过期后向服务器确认是否有变化')
+    parser.add_argument('--server', help='本地模拟服务器地址，如 http://127.0.0.1:8899')
+    args = parser.parse_args()
+    if args.crawl:
+        sys.exit(0 if crawl_all(args.output, args.workers, args.max_age, args.server) else 1)
+    else:
+        main()
@@ -0,0 +1,160 @@
+# -*- coding:utf-8 -*-
+"""
+抢购流程性能基准
+在本地模拟京东服务器上依次运行各抢购引擎，统计每秒尝试次数、从触发到第一次提交订单的耗时及提交订单的尾延迟
+
+python benchmark.py --modes async:1,async:10,pipeline:2,process:4 --output bench.json
+python benchmark.py --baseline bench.json    # 与基准结果对比，性能下降超过阈值时返回非零退出码
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from dataclasses import replace
+from datetime import datetime
+
+from config import get_settings
+from engine import AsyncPullOff, PipelinePullOff
+from jd_auto_buy import JDWrapper
+from mock_server import MockJDServer, MockOptions
+from tracing import tracer, percentile
+
+
+def in_process(engine):
+    """在当前进程中运行的引擎，耗时记录直接从 tracer 读取"""
+    def run(wrapper, concurrency):
+        tracer.spans = []
+        engine(wrapper, concurrency).run()
+        return [span.to_dict() for span in tracer.spans]
+    return run
+
+
+def process_pool(wrapper, processes):
+    """多进程引擎的耗时记录在各子进程中，由子进程导出到文件后汇总"""
+    fd, path = tempfile.mkstemp(prefix='benchmark-', suffix='.jsonl')
+    os.close(fd)
+    wrapper.process_pool = processes
+    wrapper.trace_export = path
+    # fork 出的子进程会继承当前进程已记录的 span
+    tracer.spans = []
+    try:
+        wrapper.pull_off_proc_pool()
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    finally:
+        os.remove(path)
+
+
+ENGINES = {
+    'async': in_process(AsyncPullOff),
+    'pipeline': in_process(PipelinePullOff),
+    'process': process_pool,
+}
+
+METRICS = ('attempts_per_second', 'trigger_lateness_ms', 'trigger_to_first_submit_ms', 'submit_p50_ms', 'submit_p99_ms')
+
+
+def run_mode(mode, args):
+    name, _, concurrency = mode.partition(':')
+    lead = args.lead
+    options = MockOptions(latency=args.latency, jitter=args.jitter, clock_skew=args.clock_skew,
+                          open_after=lead * 1000, win_after=args.window * 1000,
+                          rate_limit_ratio=args.rate_limit_ratio, busy_ratio=args.busy_ratio)
+    server = MockJDServer(options).start()
+    try:
+        wrapper = JDWrapper(replace(get_settings(), mock_server=server.url, trace_enable=True))
+        wrapper.nick_name = 'mock'
+        # 模拟服务器以启动时间为准开放抢购，JDWrapper 初始化耗时需要扣除
+        wrapper.timer.set_buy_time(datetime.fromtimestamp((server.started + options.open_after) / 1000))
+        spans = ENGINES[name](wrapper, int(concurrency or 1))
+    finally:
+        server.stop()
+
+    result = dict({'mode': mode, 'attempts': 0}, **dict.fromkeys(METRICS))
+    # 多进程模式下每个进程各自等待触发，以最早触发的为准；perf_counter 在同一台机器的各进程间可以比较
+    fired = min((span for span in spans if span['phase'] == 'timer_wait'), key=lambda x: x['end_ns'], default=None)
+    submits = sorted((span for span in spans if span['phase'] == 'submit_order'), key=lambda x: x['start_ns'])
+    if fired is None or not submits:
+        # 未触发或没有提交过订单（如一直未获取到抢购链接），没有可统计的数据
+        return result
+
+    latencies = sorted(span['elapsed_ms'] for span in submits)
+    duration = (submits[-1]['end_ns'] - fired['end_ns']) / 1000000000
+    result.update({
+        'attempts': len(submits),
+        'attempts_per_second': len(submits) / duration,
+        'trigger_lateness_ms': fired['lateness_ms'],
+        'trigger_to_first_submit_ms': (submits[0]['start_ns'] - fired['end_ns']) / 1000000,
+        'submit_p50_ms': percentile(latencies, 0.5),
+        'submit_p99_ms': percentile(latencies, 0.99),
+    })
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """尝试次数下降或延迟上升超过 tolerance 比例即视为性能回退"""
+    regressions = []
+    previous = {result['mode']: result for result in baseline}
+    for result in results:
+        before = previous.get(result['mode'])
+        if before is None:
+            continue
+        if not result['attempts']:
+            if before['attempts']:
+                regressions.append('{} 没有提交订单'.format(result['mode']))
+            continue
+        if not before['attempts']:
+            continue
+        if result['attempts_per_second'] < before['attempts_per_second'] * (1 - tolerance):
+            regressions.append('{} attempts/s {:.1f} -> {:.1f}'.format(
+                result['mode'], before['attempts_per_second'], result['attempts_per_second']))
+        for key in ('trigger_to_first_submit_ms', 'submit_p99_ms'):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append('{} {} {:.1f} -> {:.1f}'.format(result['mode'], key, before[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='抢购流程性能基准')
+    parser.add_argument('--modes', default='async:1,async:10,pipeline:2',
+                        help='引擎:并发数，多个用逗号分隔，可选引擎：' + ','.join(ENGINES))
+    parser.add_argument('--lead', type=float, default=3, help='启动后多少秒触发抢购')
+    parser.add_argument('--window', type=float, default=3, help='开放抢购后多少秒可以下单成功，即每轮运行时长')
+    parser.add_argument('--latency', type=float, default=20, help='模拟接口延迟（毫秒）')
+    parser.add_argument('--jitter', type=float, default=5, help='模拟延迟抖动（毫秒）')
+    parser.add_argument('--clock-skew', type=float, default=0, help='模拟服务器时间偏移（毫秒）')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='返回 60017 的比例')
+    parser.add_argument('--busy-ratio', type=float, default=0.0, help='返回 90013 的比例')
+    parser.add_argument('--output', help='结果保存为 JSON 文件')
+    parser.add_argument('--baseline', help='与之对比的基准结果 JSON 文件')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的性能波动比例')
+    args = parser.parse_args()
+
+    results = [run_mode(mode.strip(), args) for mode in args.modes.split(',') if mode.strip()]
+
+    print('{:<14}{:>10}{:>12}{:>14}{:>18}{:>12}{:>12}'.format(
+        'mode', 'attempts', 'attempts/s', 'lateness(ms)', 'first submit(ms)', 'p50(ms)', 'p99(ms)'))
+    for r in results:
+        if not r['attempts']:
+            print('{:<14}{:>10}  没有提交订单，请检查日志'.format(r['mode'], 0))
+            continue
+        print('{:<14}{:>10}{:>12.1f}{:>14.3f}{:>18.1f}{:>12.1f}{:>12.1f}'.format(
+            r['mode'], r['attempts'], r['attempts_per_second'], r['trigger_lateness_ms'],
+            r['trigger_to_first_submit_ms'], r['submit_p50_ms'], r['submit_p99_ms']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('性能回退：' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,31 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import configparser
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+from variables import DEFAULT_TIMEOUT
 
 
 class Config(object):
 
     def __init__(self, config_file='config.ini'):
         self._path = os.path.join(os.getcwd(), config_file)
+        self.reload()
+
+    def reload(self):
+        """重新读取配置文件，只解析一次；getRaw 读取同一个解析器中未经插值的原始值"""
         if not os.path.exists(self._path):
             raise FileNotFoundError("No such file: config.ini")
         self._config = configparser.ConfigParser()
-        self._config.read(self._path, encoding='utf-8')
-        self._configRaw = configparser.RawConfigParser()
-        self._configRaw.read(self._path, encoding='utf-8-sig')
+        with open(self._path, encoding='utf-8-sig') as f:
+            self._config.read_file(f, self._path)
 
-    def get(self, section, name, strip_blank=True, strip_quote=True):
+    def get(self, section, name, strip_blank=True, strip_quote=True, fallback=None):
+        """fallback 不为 None 时，配置文件中没有该项（如旧版本的 config.ini）返回 fallback"""
+        if fallback is not None and not self._config.has_option(section, name):
+            return fallback
         s = self._config.get(section, name)
         if strip_blank:
             s = s.strip()
@@ -23,11 +34,166 @@ class Config(object):
 
         return s
 
-    def getboolean(self, section, name):
+    def getboolean(self, section, name, fallback=None):
+        if fallback is not None and not self._config.has_option(section, name):
+            return fallback
         return self._config.getboolean(section, name)
 
     def getRaw(self, section, name):
-        return self._configRaw.get(section, name)
+        return self._config.get(section, name, raw=True)
+
+
+@dataclass(frozen=True)
+class Settings(object):
+    """启动时从 config.ini 生成的只读配置快照
+
+    所有配置项在生成时完成类型转换与校验，运行过程中直接读取属性，不再查询 ConfigParser。
+    需要更新配置时调用 reload_settings() 生成新的快照。
+    """
+    # [account]
+    payment_pwd: str
+    # [product]
+    sku_id: str
+    quantity: str
+    buy_time: str
+    last_purchase_time: str
+    # [config]
+    timeout: float
+    eid: str
+    fp: str
+    track_id: str
+    risk_control: str
+    uuid: str
+    sync_samples: int
+    sync_best_samples: int
+    clock_resync: bool
+    prewarm_seconds: float
+    pool_size: int
+    link_lead: float
+    link_interval: float
+    link_probes: int
+    engine: str
+    process_pool: int
+    concurrency: int
+    pipeline_depth: int
+    backoff_base: float
+    backoff_max: float
+    random_user_agent: bool
+    mock_server: str
+    # [log]
+    log_mode: str
+    log_queue_size: int
+    log_overflow: str
+    # [trace]
+    trace_enable: bool
+    trace_export: str
+    # [messenger]
+    messenger_enable: bool
+    sckey: str
+
+    ENGINES = ('async', 'pipeline', 'process')
+
+    @classmethod
+    def from_config(cls, config):
+        """原版 config.ini 中没有的配置项使用 fallback，与随附的 config.ini 默认值一致"""
+        timeout = config.get('config', 'timeout')
+        settings = cls(
+            payment_pwd=config.get('account', 'payment_pwd'),
+            sku_id=config.get('product', 'sku_id'),
+            quantity=config.get('product', 'quantity'),
+            buy_time=config.getRaw('product', 'buy_time').strip(),
+            last_purchase_time=config.getRaw('product', 'last_purchase_time').strip(),
+            timeout=float(timeout) if timeout else DEFAULT_TIMEOUT,
+            eid=config.get('config', 'eid'),
+            fp=config.get('config', 'fp'),
+            track_id=config.get('config', 'track_id'),
+            risk_control=config.get('config', 'risk_control'),
+            uuid=config.get('config', 'uuid'),
+            sync_samples=int(config.get('config', 'sync_samples', fallback='8')),
+            sync_best_samples=int(config.get('config', 'sync_best_samples', fallback='3')),
+            clock_resync=config.getboolean('config', 'clock_resync', fallback=True),
+            prewarm_seconds=float(config.get('config', 'prewarm_seconds', fallback='30')),
+            pool_size=int(config.get('config', 'pool_size', fallback='10')),
+            link_lead=float(config.get('config', 'link_lead', fallback='1')),
+            link_interval=float(config.get('config', 'link_interval', fallback='0.02')),
+            link_probes=int(config.get('config', 'link_probes', fallback='2')),
+            engine=config.get('config', 'engine', fallback='async'),
+            process_pool=int(config.get('config', 'process_pool')),
+            concurrency=int(config.get('config', 'concurrency', fallback='10')),
+            pipeline_depth=int(config.get('config', 'pipeline_depth', fallback='2')),
+            backoff_base=float(config.get('config', 'backoff_base', fallback='0.1')),
+            backoff_max=float(config.get('config', 'backoff_max', fallback='2')),
+            random_user_agent=config.getboolean('config', 'random_user_agent'),
+            mock_server=config.get('config', 'mock_server', fallback=''),
+            log_mode=config.get('log', 'mode', fallback='async'),
+            log_queue_size=int(config.get('log', 'queue_size', fallback='10000')),
+            log_overflow=config.get('log', 'overflow', fallback='drop'),
+            trace_enable=config.getboolean('trace', 'enable', fallback=True),
+            trace_export=config.get('trace', 'export', fallback='jd-trace.jsonl'),
+            messenger_enable=config.getboolean('messenger', 'enable'),
+            sckey=config.get('messenger', 'sckey'),
+        )
+        settings.validate()
+        return settings
+
+    def validate(self):
+        for name in ('buy_time', 'last_purchase_time'):
+            try:
+                datetime.strptime(getattr(self, name), '%H:%M:%S.%f')
+            except ValueError:
+                raise ValueError('配置项 {} 格式错误，应为 时:分:秒.毫秒，如 09:59:59.500'.format(name))
+        for field in fields(self):
+            if field.type is int and getattr(self, field.name) < 1:
+                raise ValueError('配置项 {} 必须为正整数'.format(field.name))
+        if self.link_lead < 0 or self.link_interval <= 0:
+            raise ValueError('配置项 link_lead 不能小于 0，link_interval 必须大于 0')
+        if not 0 < self.backoff_base <= self.backoff_max:
+            raise ValueError('配置项 backoff_base 必须大于 0 且不大于 backoff_max')
+        if not self.sku_id:
+            raise ValueError('配置项 sku_id 不能为空')
+        skus = [item.strip() for item in self.sku_id.split(',') if item.strip()]
+        if not all(re.fullmatch(r'\d+\s*(:\s*\d+)?', item) for item in skus):
+            raise ValueError('配置项 sku_id 格式错误，应为 商品id 或 商品id:数量，多个商品用英文逗号分隔')
+        if len(skus) > 1 and self.engine == 'process':
+            raise ValueError('配置多个商品时 engine 只能为 async/pipeline')
+        if self.engine not in self.ENGINES:
+            raise ValueError('配置项 engine 只能为 {}'.format('/'.join(self.ENGINES)))
+        if self.log_mode not in ('async', 'sync') or self.log_overflow not in ('drop', 'block'):
+            raise ValueError('配置项 [log] mode 只能为 async/sync，overflow 只能为 drop/block')
+        if self.messenger_enable and not self.sckey:
+            raise ValueError('开启消息推送必须配置 sckey')
+
+
+_config = None
+_settings = None
+
+
+def get_config():
+    """首次调用时才读取 config.ini，导入本模块不读取文件"""
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
+
+
+def __getattr__(name):
+    # 兼容原来的 from config import global_config
+    if name == 'global_config':
+        return get_config()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def get_settings():
+    """当前的配置快照，首次调用时生成"""
+    global _settings
+    if _settings is None:
+        _settings = Settings.from_config(get_config())
+    return _settings
 
 
-global_config = Config()
+def reload_settings():
+    """重新读取 config.ini 并生成新的配置快照，已持有旧快照的对象需要自行替换"""
+    global _settings
+    get_config().reload()
+    _settings = Settings.from_config(get_config())
+    return _settings
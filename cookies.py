@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from requests.cookies import RequestsCookieJar, create_cookie
+
+from log import logger
+
+
+def atomic_write(path, data):
+    """先写入同目录下的临时文件再替换，其他进程读到的总是完整的文件"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class CookieStore(object):
+    """按账号昵称保存 cookie 的 JSON 存储
+
+    每个账号一个 <昵称>.json 文件，index.json 记录各账号登录 cookie 的过期时间、最近一次在线验证时间
+    以及最近登录的账号，读取时只打开索引和一个账号文件。
+    最近在线验证过，或登录 cookie 距离过期还有 expiry_margin 秒以上时直接认为有效，否则才在线验证。
+    旧版本 pickle 格式的 *.cookies 文件在第一次读取时自动迁移。
+    """
+
+    INDEX_FILE = 'index.json'
+    # 京东登录态相关的 cookie，取其中最早的过期时间作为登录过期时间
+    AUTH_COOKIES = ('thor', 'pinId', 'pin')
+
+    def __init__(self, directory='./cookies', expiry_margin=3600, validation_ttl=600):
+        self.directory = directory
+        self.expiry_margin = expiry_margin
+        self.validation_ttl = validation_ttl
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_index(self):
+        try:
+            with open(self.path(self.INDEX_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'default': None, 'accounts': {}}
+
+    def write_index(self, index):
+        atomic_write(self.path(self.INDEX_FILE), json.dumps(index, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def load(self, nick_name=None):
+        """读取账号的 cookie，不指定昵称时读取最近登录的账号
+        :return: (cookies, meta)，没有保存的 cookie 时返回 (None, None)
+        """
+        if not os.path.isdir(self.directory):
+            return None, None
+        index = self.read_index()
+        if not index['accounts']:
+            self.migrate()
+            index = self.read_index()
+
+        nick_name = nick_name or index['default']
+        meta = index['accounts'].get(nick_name)
+        if meta is None:
+            return None, None
+        try:
+            with open(self.path(meta['file']), encoding='utf-8') as f:
+                records = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error('读取账号%s的cookie失败: %s', nick_name, e)
+            return None, None
+
+        jar = RequestsCookieJar()
+        for record in records:
+            jar.set_cookie(create_cookie(**record))
+        return jar, dict(meta, nick_name=nick_name)
+
+    def save(self, nick_name, cookies, validated=True):
+        os.makedirs(self.directory, exist_ok=True)
+        records = [{
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'expires': cookie.expires,
+            'secure': cookie.secure,
+            'rest': {'HttpOnly': None} if cookie.has_nonstandard_attr('HttpOnly') else {},
+        } for cookie in cookies]
+        file = '{}.json'.format(nick_name)
+        atomic_write(self.path(file), json.dumps(records, ensure_ascii=False).encode('utf-8'))
+
+        index = self.read_index()
+        index['default'] = nick_name
+        index['accounts'][nick_name] = {
+            'file': file,
+            'expires': self.auth_expires(cookies),
+            'validated': time.time() if validated else None,
+        }
+        self.write_index(index)
+
+    def mark_validated(self, nick_name):
+        index = self.read_index()
+        if nick_name in index['accounts']:
+            index['accounts'][nick_name]['validated'] = time.time()
+            self.write_index(index)
+
+    def auth_expires(self, cookies):
+        """登录 cookie 中最早的过期时间，全部为会话 cookie 时返回 None"""
+        expires = [cookie.expires for cookie in cookies if cookie.name in self.AUTH_COOKIES and cookie.expires]
+        return min(expires) if expires else None
+
+    def is_fresh(self, meta):
+        """不访问网络判断登录是否有效：validation_ttl 秒内在线验证过，或距离过期还有 expiry_margin 秒以上"""
+        if not meta:
+            return False
+        now = time.time()
+        if meta.get('validated') and now - meta['validated'] < self.validation_ttl:
+            return True
+        return bool(meta.get('expires')) and meta['expires'] - now > self.expiry_margin
+
+    def migrate(self):
+        """把旧版本 pickle 格式的 <昵称>.cookies 文件转换为 JSON，原文件重命名为 .bak"""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.cookies'):
+                continue
+            legacy = self.path(name)
+            try:
+                with open(legacy, 'rb') as f:
+                    cookies = pickle.load(f)
+            except Exception as e:
+                logger.error('迁移旧版cookie文件%s失败: %s', name, e)
+                continue
+            # 旧文件中没有验证记录，第一次使用时按过期时间判断或在线验证
+            self.save(name[:-len('.cookies')], cookies, validated=False)
+            os.replace(legacy, legacy + '.bak')
+            logger.info('已将旧版cookie文件%s迁移为JSON格式', name)
@@ -0,0 +1,236 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import contextvars
+import functools
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from log import logger
+from retry import SUCCESS, CANCELLED
+from tracing import tracer
+
+
+class AsyncPullOff(object):
+    """基于 asyncio 的单进程并发抢购引擎
+
+    所有下单流程共享同一个 JDWrapper（同一个 session 及其连接池），只等待一次购买时间、只获取一次抢购链接，
+    之后由 concurrency 个协程并发提交订单，任一协程下单成功即停止全部协程。
+    requests 本身是阻塞的，每个请求交由与并发数等大的线程池执行，协程只负责调度。
+    """
+
+    def __init__(self, wrapper, concurrency=20):
+        self.wrapper = wrapper
+        self.concurrency = max(int(concurrency), 1)
+        self._executor = None
+        self._stop = None
+        # 不决定抢购结果的辅助协程，结束时随下单协程一起取消
+        self._background = []
+
+    def run(self):
+        return asyncio.run(self._main())
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # 线程池不会继承协程的上下文，复制一份以保留当前的抢购尝试编号
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, functools.partial(func, *args, **kwargs))
+
+    async def _main(self):
+        self._stop = asyncio.Event()
+        with ThreadPoolExecutor(self.max_workers(), thread_name_prefix='pull-off') as self._executor:
+            # 等待购买时间、获取并访问抢购链接，整个进程只做一次
+            if not await self.call(self.wrapper.request_url):
+                logger.info('已过最后购买时间%s，未能获取抢购链接', self.wrapper.timer.last_purchase_time)
+                return None
+
+            winner = await self.race()
+
+        self.wrapper.retry.report()
+        return winner
+
+    async def race(self):
+        """抢购链接已访问，启动下单协程直到抢购成功或结束，返回成功的协程编号"""
+        workers = self.spawn()
+        try:
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+            winner = next(iter(done)).result()
+            if winner is None:
+                # 商品已抢完或已过最后购买时间，其余协程在各自的请求结束后退出，其间仍可能有协程下单成功
+                results = await asyncio.gather(*workers, return_exceptions=True)
+                winner = next((result for result in results if isinstance(result, int)), None)
+        finally:
+            self._stop.set()
+            for task in workers + self._background:
+                task.cancel()
+            await asyncio.gather(*workers, *self._background, return_exceptions=True)
+
+        if winner is not None:
+            logger.info('商品%s协程%s抢购成功，已停止全部%s个协程', self.wrapper.sku_id, winner, len(workers))
+        return winner
+
+    def max_workers(self):
+        return self.concurrency
+
+    def spawn(self):
+        """创建下单协程，任一协程返回即表示抢购成功"""
+        return [asyncio.create_task(self.worker(i)) for i in range(self.concurrency)]
+
+    def running(self):
+        return not self._stop.is_set() and not self.wrapper.retry.finished()
+
+    async def backoff(self):
+        """按上一次提交结果等待，返回 False 表示无需等待"""
+        delay = self.wrapper.retry.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return bool(delay)
+
+    async def worker(self, index):
+        """下单协程，抢购成功时返回协程编号，商品已抢完或超过最后购买时间时返回 None"""
+        while self.running():
+            if await self.backoff():
+                continue
+            try:
+                with tracer.attempt():
+                    if await self.call(self.wrapper.submit_order):
+                        return index
+            except Exception as e:
+                logger.info('协程%s抢购发生异常，稍后继续执行！%s', index, e)
+                self.wrapper.retry.record(None)
+
+
+class PipelinePullOff(AsyncPullOff):
+    """流水线抢购引擎
+
+    获取初始化信息（结算页面 + init.action）与提交订单拆成两个阶段并行执行：
+    提交订单等待响应的同时，下一次提交所需的 token 已经在获取中。
+    每个阶段最多同时有 depth 个请求在途，阶段之间通过容量为 depth 的队列传递 token，
+    各阶段耗时见运行结束时的耗时报告。
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, wrapper, depth=2):
+        super().__init__(wrapper, depth)
+        self.depth = self.concurrency
+        self._tokens = None
+
+    def max_workers(self):
+        return self.depth * 2
+
+    def spawn(self):
+        self._tokens = asyncio.Queue(maxsize=self.depth)
+        # 购买时间前预先获取的 token 直接交给提交阶段，触发后第一次提交不必等待一轮初始化
+        token = self.wrapper.order_token.get(self.wrapper.sku_id)
+        if token:
+            self._tokens.put_nowait(token)
+        self._background = [asyncio.create_task(self.init_stage(i)) for i in range(self.depth)]
+        return [asyncio.create_task(self.submit_stage(i)) for i in range(self.depth)]
+
+    async def timed(self, stage, func, *args):
+        """阶段耗时记录为 stage_<名称>，与其中的 HTTP 请求一起出现在耗时报告中"""
+        with tracer.span('stage_' + stage):
+            return await self.call(func, *args)
+
+    async def init_stage(self, index):
+        while self.running():
+            try:
+                token = await self.timed('init', self.wrapper.refresh_order_data)
+            except Exception as e:
+                logger.info('流水线%s获取初始化信息失败，稍后继续执行！%s', index, e)
+                await asyncio.sleep(random.randint(100, 300) / 1000)
+                continue
+            await self._tokens.put(token)
+
+    async def submit_stage(self, index):
+        while self.running():
+            if await self.backoff():
+                continue
+            try:
+                # 定时醒来检查是否需要停止，token 一入队即可取得，不增加等待时间
+                token = await asyncio.wait_for(self._tokens.get(), self.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                with tracer.attempt():
+                    if await self.timed('submit', self.wrapper.submit_order, token):
+                        return index
+            except Exception as e:
+                logger.info('流水线%s提交订单发生异常，稍后继续执行！%s', index, e)
+                self.wrapper.retry.record(None)
+
+
+class MultiPullOff(object):
+    """多个商品同时抢购
+
+    每个商品一个 AsyncPullOff/PipelinePullOff，共用同一个 session（连接池）、同一个事件循环和线程池，
+    只等待一次购买时间，之后各商品分别获取抢购链接并下单。engines 按优先级排列，
+    某个商品抢购成功时立即取消排在它后面的商品，排在前面的商品继续抢购；
+    排在后面的商品已经在线程池中执行的下单流程在发出提交请求前检查，不再提交。
+    已经发出的提交请求仍可能成功，抢购结果以线程池全部结束后各商品的 retry 为准。
+    """
+
+    def __init__(self, wrapper, engines):
+        self.wrapper = wrapper
+        self.engines = engines
+        self._executor = None
+
+    def run(self):
+        """返回抢购成功的商品id列表"""
+        return asyncio.run(self._main())
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, functools.partial(func, *args))
+
+    async def _main(self):
+        max_workers = sum(engine.max_workers() for engine in self.engines) + len(self.engines)
+        with ThreadPoolExecutor(max_workers, thread_name_prefix='pull-off') as self._executor:
+            for index, engine in enumerate(self.engines):
+                engine.wrapper.retry.higher = tuple(higher.wrapper.retry for higher in self.engines[:index])
+                engine._executor = self._executor
+                engine._stop = asyncio.Event()
+            # 各商品的订单模板并发预先生成，之后只等待一次购买时间
+            await asyncio.gather(*(self.call(engine.wrapper.prepare_pull_off) for engine in self.engines))
+            await self.call(self.wrapper.wait_for_buy_time)
+
+            tasks = [asyncio.create_task(self.run_engine(engine)) for engine in self.engines]
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.error('商品%s抢购发生异常：%s', self.engines[tasks.index(task)].wrapper.sku_id,
+                                     task.exception())
+                    if not self.succeeded(task):
+                        continue
+                    index = tasks.index(task)
+                    for engine, lower in zip(self.engines[index + 1:], tasks[index + 1:]):
+                        self.cancel(engine, lower)
+
+        # 线程池已经结束，取消前已发出的提交请求都有了结果
+        for engine in self.engines:
+            engine.wrapper.retry.report('商品{}'.format(engine.wrapper.sku_id))
+        winners = [engine.wrapper.sku_id for engine in self.engines if engine.wrapper.retry.outcome == SUCCESS]
+        logger.info('多个商品抢购结束，抢购成功的商品：%s', '，'.join(winners) or '无')
+        return winners
+
+    @staticmethod
+    def succeeded(task):
+        return not task.cancelled() and task.exception() is None and task.result() is not None
+
+    def cancel(self, engine, task):
+        # 本商品已有结果时不再取消；提交订单前的检查可能已经将其标记为取消
+        if engine.wrapper.retry.outcome not in (None, CANCELLED):
+            return
+        logger.info('商品%s优先级更高的商品已抢购成功，停止抢购', engine.wrapper.sku_id)
+        # 线程中正在获取抢购链接或退避等待的流程通过 retry 停止，协程直接取消
+        engine.wrapper.retry.cancel()
+        engine._stop.set()
+        task.cancel()
+
+    async def run_engine(self, engine):
+        if not await engine.call(engine.wrapper.open_pull_off_url):
+            return None
+        return await engine.race()
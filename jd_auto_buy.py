@@ -1,23 +1,33 @@
 # -*- coding: utf-8 -*-
 
-import json
+import copy
 import os
-import pickle
 import random
-from time import time, sleep
-from lxml import etree
+import threading
+from datetime import datetime
+from time import time, sleep, monotonic, perf_counter
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from config import global_config
+from config import get_settings, reload_settings
+from cookies import CookieStore
 from exception import AsstException
-from log import logger
+from link import LinkProber
+from log import logger, set_logger
 from messenger import Messenger
+from prewarm import ConnectionWarmer, HOT_HOSTS
+from product import ProductMeta
+from retry import RetryController, StopSignal, install_signal, current_signal, SUCCESS
+from terminal_qr import render_png
 from timer import Timer
+from tracing import tracer, TracedSession
 from utils import get_random_user_agent
-from utils import response_status, save_image, open_image, parse_json, check_login, wait_some_time
+from utils import response_status, check_login, wait_some_time
+from utils import parse_response, parse_json_fields, parse_sku_id, request_headers_only
+from utils import ACCEPT_ENCODING
 from variables import DEFAULT_USER_AGENT
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
 
 class JDSession:
@@ -26,15 +36,32 @@ class JDSession:
       COOKIES
     ===================================
     """
-    use_random_ua = global_config.getboolean('config', 'random_user_agent')
 
-    def __init__(self):
+    def __init__(self, settings=None):
+        settings = settings or get_settings()
+        self.use_random_ua = settings.random_user_agent
+        self.pool_size = settings.pool_size
+        # 本地模拟京东服务器地址，设置后所有请求都发往该地址，用于离线测试与性能基准
+        self.mock_server = settings.mock_server
         self.user_agent = DEFAULT_USER_AGENT if not self.use_random_ua else get_random_user_agent()
         self.sess = self.__start_session()
+        # 模拟服务器的账号单独保存，避免覆盖真实账号的 cookie 及验证时间
+        self.cookie_store = CookieStore('./cookies/mock' if self.mock_server else './cookies')
+        self.cookie_meta = None
 
     def __start_session(self):
-        session = requests.session()
+        session = TracedSession()
         session.headers = self.get_headers()
+        # 每个域名保留 pool_size 个长连接，供预热后的抢购请求复用
+        if self.mock_server:
+            from mock_server import MockAdapter
+            # 所有域名共用模拟服务器的同一个连接池
+            adapter = MockAdapter(self.mock_server, pool_connections=1,
+                                  pool_maxsize=self.pool_size * len(HOT_HOSTS))
+        else:
+            adapter = HTTPAdapter(pool_connections=len(HOT_HOSTS) + 1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
         return session
 
     def get_headers(self):
@@ -43,6 +70,8 @@ class JDSession:
                           "q=0.9,image/webp,image/apng,*/*;"
                           "q=0.8,application/signed-exchange;"
                           "v=b3",
+                # session 的请求头整个被替换，需要声明可接受的压缩编码，否则服务器返回未压缩的响应体
+                "Accept-Encoding": ACCEPT_ENCODING,
                 "Connection": "keep-alive"}
 
     def get_user_agent(self):
@@ -75,26 +104,25 @@ class JDSession:
         return False
 
     def load_cookies(self):
-        cookies_file = ''
-        for name in os.listdir('./cookies'):
-            if name.endswith('.cookies'):
-                cookies_file = './cookies/{0}'.format(name)
-                break
-
-        if cookies_file == '':
+        cookies, self.cookie_meta = self.cookie_store.load()
+        if cookies is None:
             return False
+        self.set_cookies(cookies)
+        return True
 
-        with open(cookies_file, 'rb') as f:
-            local_cookies = pickle.load(f)
-        self.set_cookies(local_cookies)
+    def check_cookies(self, force=False):
+        """判断登录是否有效，本地记录的过期时间足够时不访问网络"""
+        if not force and self.cookie_store.is_fresh(self.cookie_meta):
+            logger.info('账号%s的cookie未过期，跳过在线验证', self.cookie_meta['nick_name'])
+            return True
+        valid = self.validate_cookies()
+        if valid and self.cookie_meta:
+            self.cookie_store.mark_validated(self.cookie_meta['nick_name'])
+        return valid
 
     def save_cookies(self, nick_name):
-        cookies_file = './cookies/{0}.cookies'.format(nick_name)
-        directory = os.path.dirname(cookies_file)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(cookies_file, 'wb') as f:
-            pickle.dump(self.sess.cookies, f)
+        self.cookie_store.save(nick_name, self.sess.cookies)
+        self.cookie_meta = self.cookie_store.load(nick_name)[1]
 
 
 class JDLogin:
@@ -104,15 +132,40 @@ class JDLogin:
     ===================================
     """
 
-    def __init__(self, jd_session: JDSession):
+    # 扫码状态轮询间隔（秒）：显示二维码后 QR_FAST_PERIOD 秒内及已扫码待确认时加快，其余时间放慢
+    QR_POLL_FAST = 0.5
+    QR_POLL_SCANNED = 0.3
+    QR_POLL_SLOW = 2
+    QR_FAST_PERIOD = 15
+    # 二维码有效期约 3 分钟
+    QR_TIMEOUT = 170
+
+    def __init__(self, jd_session: JDSession, has_cookies=True):
         self.qr_code_file = 'qr_code.png'
         self.jd_session = jd_session
         self.sess = self.jd_session.get_session()
-        self.is_login = False
-        self.login_status_checker()
+        # 没有本地 cookie 时一定未登录；有 cookie 时推迟到第一次读取登录状态时再访问网络验证
+        self._is_login = None if has_cookies else False
+        self.last_qr_code = None
+        self._login_thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_login_thread'] = None
+        return state
 
-    def login_status_checker(self):
-        self.is_login = self.jd_session.validate_cookies()
+    @property
+    def is_login(self):
+        if self._is_login is None:
+            self.login_status_checker()
+        return self._is_login
+
+    @is_login.setter
+    def is_login(self, value):
+        self._is_login = value
+
+    def login_status_checker(self, force=False):
+        self.is_login = self.jd_session.check_cookies(force)
 
     def get_login_page(self):
         url = "https://passport.jd.com/new/login.aspx"
@@ -136,12 +189,20 @@ class JDLogin:
             logger.info('获取二维码失败')
             return False
 
-        save_image(resp, self.qr_code_file)
-        logger.info('请打开京东手机客户端，准备扫码登陆:')
-        open_image(self.qr_code_file)
+        with open(self.qr_code_file, 'wb') as f:
+            f.write(resp.content)
+        logger.info('请打开京东手机客户端，准备扫码登陆（二维码图片：%s）:', self.qr_code_file)
+        # 直接在终端显示，无需启动图片查看器，也适用于没有图形界面的服务器
+        try:
+            print(render_png(resp.content))
+        except ValueError as e:
+            logger.error('二维码无法在终端显示，请打开图片扫码: %s', e)
         return True
 
-    def get_qrcode_ticket(self):
+    def check_qrcode(self):
+        """查询一次扫码状态
+        :return: (code, ticket)，code 为 201 未扫描、202 已扫描待确认、203 二维码过期、200 已确认
+        """
         url = 'https://qr.m.jd.com/check'
         payload = {
             'appid': '133',
@@ -157,16 +218,35 @@ class JDLogin:
 
         if not response_status(resp):
             logger.error('获取二维码扫描结果异常')
-            return False
+            return None, None
+
+        resp_json = parse_json_fields(resp.content, ('code', 'msg', 'ticket'))
+        if resp_json.get('code') != self.last_qr_code:
+            self.last_qr_code = resp_json.get('code')
+            logger.info('Code: %s, Message: %s', resp_json.get('code'), resp_json.get('msg'))
+        return resp_json.get('code'), resp_json.get('ticket')
+
+    def qr_poll_interval(self, code, elapsed):
+        """刚显示二维码及已扫码待确认时快速轮询，其余时间放慢"""
+        if code == 202:
+            return self.QR_POLL_SCANNED
+        if elapsed < self.QR_FAST_PERIOD:
+            return self.QR_POLL_FAST
+        return self.QR_POLL_SLOW
 
-        resp_json = parse_json(resp.text)
-
-        if resp_json['code'] != 200:
-            logger.info('Code: %s, Message: %s', resp_json['code'], resp_json['msg'])
-            return None
-        else:
-            logger.info('已完成手机客户端确认')
-            return resp_json['ticket']
+    def get_qrcode_ticket(self):
+        """轮询扫码状态直到手机客户端确认，返回 ticket"""
+        self.last_qr_code = None
+        begin = monotonic()
+        while monotonic() - begin < self.QR_TIMEOUT:
+            code, ticket = self.check_qrcode()
+            if code == 200 and ticket:
+                logger.info('已完成手机客户端确认')
+                return ticket
+            if code == 203:
+                break
+            sleep(self.qr_poll_interval(code, monotonic() - begin))
+        raise AsstException('二维码过期，请重新获取扫描')
 
     def validate_qrcode_ticket(self, ticket):
         url = 'https://passport.jd.com/uc/qrCodeTicketValidation'
@@ -178,7 +258,7 @@ class JDLogin:
         if not response_status(resp):
             return False
 
-        resp_json = json.loads(resp.text)
+        resp_json = parse_response(resp)
         if resp_json['returnCode'] == 0:
             return True
         else:
@@ -193,24 +273,40 @@ class JDLogin:
             raise AsstException('二维码下载失败')
 
         # get QR code ticket
-        retry_times = 85
-        for _ in range(retry_times):
-            ticket = self.get_qrcode_ticket()
-            logger.info(f'Ticket: {ticket}')
-            if ticket:
-                break
-            sleep(2)
-        else:
-            raise AsstException('二维码过期，请重新获取扫描')
+        ticket = self.get_qrcode_ticket()
 
         # validate QR code ticket
         if not self.validate_qrcode_ticket(ticket):
             raise AsstException('二维码信息校验失败')
 
-        self.login_status_checker()
+        self.login_status_checker(force=True)
 
         logger.info('二维码登录成功')
 
+    def login_in_background(self, on_login=None):
+        """在后台线程中扫码登录，不阻塞时间同步等其他启动工作，已在进行时不重复发起"""
+        if self._login_thread is not None and self._login_thread.is_alive():
+            return self._login_thread
+
+        def run():
+            try:
+                self.login_by_qrcode()
+                if on_login is not None and self.is_login:
+                    on_login()
+            except Exception as e:
+                logger.error('后台扫码登录失败: %s', e)
+
+        self._login_thread = threading.Thread(target=run, name='qr-login', daemon=True)
+        self._login_thread.start()
+        return self._login_thread
+
+    def wait_login(self):
+        """等待后台扫码登录结束，返回是否已登录"""
+        if self._login_thread is not None:
+            self._login_thread.join()
+            self._login_thread = None
+        return self.is_login
+
     def get_user_info(self):
         url = 'https://passport.jd.com/user/petName/getUserInfoForMiniJd.action'
         payload = {
@@ -223,51 +319,200 @@ class JDLogin:
         }
 
         resp = self.sess.get(url=url, params=payload, headers=headers)
-        resp_json = parse_json(resp.text)
+        resp_json = parse_response(resp)
         logger.info(resp_json)
         return resp_json.get('nickName') or 'jd'
 
 
 class JDWrapper(object):
-    def __init__(self):
-        self.uuid = global_config.get('config', 'uuid')
-        self.eid = global_config.get('config', 'eid')
-        self.fp = global_config.get('config', 'fp')
-        self.sku_id = global_config.get('product', 'sku_id')
-        self.quantity = global_config.get('product', 'quantity')
-        self.send_message = global_config.getboolean('messenger', 'enable')
-        self.messenger = Messenger(global_config.get('messenger', 'sckey')) if self.send_message else None
-
-        self.jd_session = JDSession()
-        self.jd_session.load_cookies()
-
-        self.qr_login = JDLogin(self.jd_session)
-        self.is_login = self.qr_login.is_login
+    # 提交订单返回这些信息时认为 token 已失效，需要重新获取初始化信息
+    ORDER_TOKEN_STALE_KEYWORDS = ('token', '过期', '失效', '重新进入')
+    # 提交订单的返回结果中需要用到的字段
+    SUBMIT_RESULT_FIELDS = ('success', 'resultCode', 'errorMessage', 'orderId', 'totalMoney', 'pcUrl')
+    # 常驻模式下提前多少秒结束空闲等待，检查登录状态后进入抢购流程（连接预热、时间同步）
+    DAEMON_LEAD = 300
+    DAEMON_KEEPALIVE = 1800
+    # 等待抢购链接时每隔多少秒检查一次是否需要停止
+    LINK_WAIT = 0.1
+
+    def __init__(self, settings=None):
+        settings = settings or get_settings()
+        set_logger(settings)
+        self.apply_settings(settings)
+
+        tracer.install()
+        self.jd_session = JDSession(self.settings)
+        has_cookies = self.jd_session.load_cookies()
+
+        # 构造时不访问网络，登录状态、京东服务器时间及商品信息在第一次使用时获取，或由 prepare 并发获取
+        self.qr_login = JDLogin(self.jd_session, has_cookies)
         self.session = self.jd_session.get_session()
         self.user_agent = self.jd_session.user_agent
         self.nick_name = None
+        self.product_meta = ProductMeta(self.session)
 
-        self.timer = Timer()
-
-        self.process_pool = global_config.get('config', 'process_pool')
+        self.timer = Timer(session=self.session, settings=self.settings)
+        self.retry = RetryController(self.timer, self.settings.backoff_base, self.settings.backoff_max)
 
         self.pull_off_url = dict()
         self.pull_off_init_info = dict()
         self.order_data = dict()
+        self.order_template = dict()
+        self.order_token = dict()
+        # 商品id -> LinkProber，多个商品时各商品的浅拷贝共用
+        self.link_probers = dict()
+
+    @property
+    def is_login(self):
+        return self.qr_login.is_login
+
+    @is_login.setter
+    def is_login(self, value):
+        self.qr_login.is_login = value
+
+    def prepare(self):
+        """并发执行启动检查：验证登录状态、同步京东服务器时间、读取商品信息
+        :return: 各项检查的耗时，单位毫秒
+        """
+        probes = {
+            'login': self.check_login_or_scan,
+            'clock': self.timer.sync,
+            'sku': self.get_sku_title,
+        }
+        timings = dict()
+
+        def run(name):
+            begin = perf_counter()
+            try:
+                probes[name]()
+            except Exception as e:
+                logger.error('启动检查%s失败: %s', name, e)
+            timings[name] = (perf_counter() - begin) * 1000
+
+        begin = perf_counter()
+        with ThreadPoolExecutor(len(probes), thread_name_prefix='prepare') as pool:
+            list(pool.map(run, probes))
+        logger.info('启动检查完成，耗时%.1f毫秒（%s），登录状态：%s', (perf_counter() - begin) * 1000,
+                    '，'.join('{} {:.1f}'.format(name, timings[name]) for name in probes), self.is_login)
+        return timings
+
+    def check_login_or_scan(self):
+        """登录失效时在后台发起扫码登录，与其他启动检查同时进行，下单前由 check_login 等待完成"""
+        self.qr_login.login_status_checker()
+        if not self.is_login:
+            self.qr_login.login_in_background(self.on_login)
+
+    def apply_settings(self, settings):
+        """使用配置快照，抢购过程中只读取这里生成的属性"""
+        self.settings = settings
+        self.uuid = settings.uuid
+        self.eid = settings.eid
+        self.fp = settings.fp
+        self.payment_pwd = settings.payment_pwd
+        # 商品id -> 数量，按优先级排列；只有一个商品时与原来相同
+        self.skus = parse_sku_id(settings.sku_id, settings.quantity)
+        self.sku_id, self.quantity = next(iter(self.skus.items()))
+        self.send_message = settings.messenger_enable
+        # 重新读取配置时 sckey 不变则继续使用原来的实例，否则先发送完原实例队列中的消息并停止其后台线程
+        messenger = getattr(self, 'messenger', None)
+        if messenger is not None and not (self.send_message and messenger.sc_key == settings.sckey):
+            messenger.close()
+            messenger = None
+        if messenger is None and self.send_message:
+            messenger = Messenger(settings.sckey)
+        self.messenger = messenger
+
+        self.engine = settings.engine
+        self.process_pool = settings.process_pool
+        self.concurrency = settings.concurrency
+        self.pipeline_depth = settings.pipeline_depth
+        self.prewarm_seconds = settings.prewarm_seconds
+        tracer.enable = settings.trace_enable
+        self.link_lead = settings.link_lead
+        self.link_interval = settings.link_interval
+        self.link_probes = settings.link_probes
+        self.trace_export = settings.trace_export
+
+    def for_sku(self, sku_id, quantity):
+        """多个商品同时抢购时，每个商品一个浅拷贝
+        与原对象共用 session（连接池）、时间同步结果及按商品id索引的订单数据，只有提交结果的统计与停止判断各自独立
+        """
+        wrapper = copy.copy(self)
+        wrapper.sku_id = sku_id
+        wrapper.quantity = quantity
+        wrapper.retry = RetryController(self.timer, self.settings.backoff_base, self.settings.backoff_max)
+        return wrapper
+
+    def reload_settings(self):
+        """重新读取 config.ini，供长时间运行的进程更新配置
+        订单模板依赖支付密码、eid、fp 等配置，一并清空；session 相关配置（UA、连接数）不会更新
+        """
+        self.apply_settings(reload_settings())
+        tracer.install()
+        self.timer.settings = self.settings
+        self.timer.arm()
+        self.retry.backoff_base = self.settings.backoff_base
+        self.retry.backoff_max = self.settings.backoff_max
+        self.order_template.clear()
+        self.order_token.clear()
+
+    def run_daemon(self):
+        """常驻运行，每天在购买时间到最后购买时间之间抢购一次
+        进程、登录状态、时间同步结果与连接池在各轮之间保留，每轮结束后重新读取配置
+        """
+        while True:
+            logger.info('下一轮抢购时间：%s - %s', self.timer.buy_time, self.timer.last_purchase_time)
+            self.idle(self.timer.remaining_ms() / 1000 - self.DAEMON_LEAD)
+            self.check_session()
+            self.pull_off_url.clear()
+            self.order_token.clear()
+            try:
+                self.pull_off_start()
+            except Exception as e:
+                logger.error('本轮抢购发生异常：%s', e)
+
+            # 抢购成功后同样等到本轮结束，再设定下一轮
+            self.idle(self.timer.deadline_remaining_ms() / 1000)
+            try:
+                self.reload_settings()
+            except ValueError as e:
+                logger.error('重新读取配置失败，继续使用原有配置：%s', e)
+                self.timer.arm()
+
+    def idle(self, seconds):
+        """常驻模式下两轮之间的等待，每隔 DAEMON_KEEPALIVE 秒访问一次订单页面保持登录状态"""
+        deadline = monotonic() + seconds
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            sleep(min(remaining, self.DAEMON_KEEPALIVE))
+            if remaining > self.DAEMON_KEEPALIVE:
+                self.check_session()
+
+    def check_session(self):
+        # 常驻模式下定期访问订单页面，同时起到保持登录状态的作用，不使用本地判断
+        self.qr_login.login_status_checker(force=True)
+        if not self.is_login:
+            logger.warning('登录状态已失效，抢购前需要重新扫码登录')
 
     def login_by_qrcode(self):
-        if self.qr_login.is_login:
+        # prepare 已经在后台发起扫码登录时等待其完成
+        if self.qr_login.wait_login():
             logger.info('登录成功')
             return
 
         self.qr_login.login_by_qrcode()
 
         if self.qr_login.is_login:
-            self.nick_name = self.qr_login.get_user_info()
-            self.jd_session.save_cookies(self.nick_name)
+            self.on_login()
         else:
             raise AsstException("二维码登录失败！")
 
+    def on_login(self):
+        self.nick_name = self.qr_login.get_user_info()
+        self.jd_session.save_cookies(self.nick_name)
+
     """
     ===================================
     RESERVE
@@ -285,12 +530,12 @@ class JDWrapper(object):
             wait_some_time()
 
     def get_sku_title(self):
-        """获取商品名称"""
-        url = 'https://item.jd.com/{}.html'.format(global_config.get('product', 'sku_id'))
-        resp = self.session.get(url).content
-        x_data = etree.HTML(resp)
-        sku_title = x_data.xpath('/html/head/title/text()')
-        return sku_title[0]
+        """获取商品名称，结果有缓存，只在购买时间前实际请求一次"""
+        try:
+            return self.product_meta.get(self.sku_id)['title']
+        except Exception as e:
+            logger.error('获取商品名称失败: %s', e)
+            return ''
 
     def make_reserve(self):
         """商品预约"""
@@ -306,16 +551,17 @@ class JDWrapper(object):
             'Referer': 'https://item.jd.com/{}.html'.format(self.sku_id),
         }
         resp = self.session.get(url=url, params=payload, headers=headers)
-        resp_json = parse_json(resp.text)
+        resp_json = parse_response(resp)
         reserve_url = resp_json.get('url')
         # self.timer.start()
         while True:
             try:
-                self.session.get(url='https:' + reserve_url)
+                # 预约链接只需要访问，不读取响应体
+                request_headers_only(self.session, 'GET', 'https:' + reserve_url, allow_redirects=True)
                 logger.info('预约成功，已获得抢购资格 / 您已成功预约过了，无需重复预约')
-                if global_config.getboolean('messenger', 'enable') == 'true':
+                if self.send_message:
                     success_message = "预约成功，已获得抢购资格 / 您已成功预约过了，无需重复预约"
-                    self.send_message(success_message)
+                    self.messenger.send(success_message)
                 break
             except Exception as e:
                 logger.error('预约失败正在重试...')
@@ -326,71 +572,180 @@ class JDWrapper(object):
     ===================================
     """
 
+    def pull_off_start(self):
+        """按配置选择抢购引擎，结束后输出各阶段耗时报告"""
+        if self.trace_export and os.path.exists(self.trace_export):
+            os.remove(self.trace_export)
+        self.retry.reset()
+        try:
+            if len(self.skus) > 1:
+                self.pull_off_multi()
+            elif self.engine == 'process':
+                self.pull_off_proc_pool()
+            elif self.engine == 'pipeline':
+                self.pull_off_pipeline()
+            else:
+                self.pull_off_async()
+        finally:
+            self.stop_link_probers()
+            self.finish_trace()
+            if self.messenger is not None:
+                self.messenger.flush()
+
+    def finish_trace(self):
+        if not tracer.enable:
+            return
+        if not self.trace_export:
+            tracer.report()
+            return
+        # 多进程模式下各进程分别追加写入导出文件，报告以文件为准
+        tracer.export(self.trace_export)
+        tracer.report_file(self.trace_export)
+
+    @check_login
+    def pull_off_async(self):
+        from engine import AsyncPullOff
+        self.nick_name = self.qr_login.get_user_info()
+        AsyncPullOff(self, self.concurrency).run()
+
+    @check_login
+    def pull_off_pipeline(self):
+        from engine import PipelinePullOff
+        self.nick_name = self.qr_login.get_user_info()
+        PipelinePullOff(self, self.pipeline_depth).run()
+
+    @check_login
+    def pull_off_multi(self):
+        from engine import AsyncPullOff, PipelinePullOff, MultiPullOff
+        self.nick_name = self.qr_login.get_user_info()
+        if self.engine == 'pipeline':
+            engines = [PipelinePullOff(self.for_sku(sku_id, quantity), self.pipeline_depth)
+                       for sku_id, quantity in self.skus.items()]
+        else:
+            engines = [AsyncPullOff(self.for_sku(sku_id, quantity), self.concurrency)
+                       for sku_id, quantity in self.skus.items()]
+        if MultiPullOff(self, engines).run():
+            self.retry.outcome = SUCCESS
+
     @check_login
     def pull_off_proc_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
         self.nick_name = self.qr_login.get_user_info()
-        with ProcessPoolExecutor(int(self.process_pool)) as pool:
-            for i in range(int(self.process_pool)):
-                pool.submit(self.pull_off)
+        # 在主进程中同步一次时间，子进程直接使用结果
+        if not self.timer.synced:
+            self.timer.sync()
+        signal = StopSignal()
+        with ProcessPoolExecutor(self.process_pool, initializer=install_signal, initargs=(signal,)) as pool:
+            futures = [pool.submit(self.pull_off, i) for i in range(self.process_pool)]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error('抢购进程异常退出：%s', e)
+
+        self.retry.outcome = signal.outcome
+        if signal.outcome == SUCCESS:
+            logger.info('进程%s于%s抢购成功，已停止全部%s个进程', signal.winner,
+                        datetime.fromtimestamp(signal.time).strftime('%H:%M:%S.%f')[:-3], self.process_pool)
+        else:
+            logger.info('%s，已停止全部%s个进程', self.retry.reason(), self.process_pool)
 
     @check_login
-    def pull_off(self):
-        while True:
-            try:
-                self.request_url()
-                while True:
-                    self.request_checkout_page()
-                    self.submit_order()
-            except Exception as e:
-                logger.info('抢购发生异常，稍后继续执行！', e)
-            wait_some_time()
+    def pull_off(self, worker=None):
+        if worker is not None:
+            # 进程池中运行，与其他进程共享停止信号；spawn 方式启动的子进程重新导入模块，需要重新设置日志与耗时追踪
+            self.retry.attach(current_signal(), worker)
+            set_logger(self.settings)
+            tracer.enable = self.settings.trace_enable
+            tracer.install()
+        try:
+            while not self.retry.finished():
+                try:
+                    if not self.request_url():
+                        break
+                    while not self.retry.finished():
+                        self.retry.sleep(self.retry.delay())
+                        with tracer.attempt():
+                            self.submit_order()
+                except Exception as e:
+                    logger.info('抢购发生异常，稍后继续执行！%s', e)
+                    self.retry.record(None)
+                self.retry.sleep(self.retry.delay())
+            self.retry.report()
+        finally:
+            self.stop_link_probers()
+            if self.trace_export:
+                tracer.export(self.trace_export)
 
     def request_url(self):
-        """访问商品的抢购链接（用于设置cookie等"""
-        logger.info('用户:{}'.format(self.nick_name))
-        logger.info('商品名称:{}'.format(self.get_sku_title()))
-        self.timer.start()
-        self.pull_off_url[self.sku_id] = self.get_url()
+        """访问商品的抢购链接（用于设置cookie等
+        :return: 超过最后购买时间仍未获取到抢购链接时返回 False
+        """
+        self.prepare_pull_off()
+        self.wait_for_buy_time()
+        return self.open_pull_off_url()
+
+    def prepare_pull_off(self):
+        """购买时间前的准备：读取商品名称，预先生成订单模板"""
+        logger.info('用户:%s', self.nick_name)
+        logger.info('商品%s名称:%s', self.sku_id, self.get_sku_title())
+        if self.sku_id not in self.order_token:
+            self.prefetch_order_data()
+
+    def open_pull_off_url(self):
+        """购买时间到达后获取并访问抢购链接
+        :return: 超过最后购买时间仍未获取到抢购链接时返回 False
+        """
+        pull_off_url = self.get_url()
+        if not pull_off_url:
+            return False
+        self.pull_off_url[self.sku_id] = pull_off_url
         logger.info('访问商品的抢购连接...')
         headers = {
             'User-Agent': self.user_agent,
             'Host': 'marathon.jd.com',
             'Referer': 'https://item.jd.com/{}.html'.format(self.sku_id),
         }
-        self.session.get(
-            url=self.pull_off_url.get(
-                self.sku_id),
-            headers=headers,
-            allow_redirects=False)
+        request_headers_only(self.session, 'GET', self.pull_off_url.get(self.sku_id), headers=headers)
+        return True
+
+    def wait_for_buy_time(self):
+        """等待购买时间，等待期间预热抢购相关域名的连接池，并在购买时间前开始轮询全部商品的抢购链接"""
+        for sku_id in self.skus:
+            self.start_link_prober(sku_id)
+        warmer = None
+        if self.prewarm_seconds > 0:
+            warmer = ConnectionWarmer(self.session, self.timer, pool_size=self.jd_session.pool_size,
+                                      prewarm_seconds=self.prewarm_seconds,
+                                      resolve_dns=not self.jd_session.mock_server)
+            warmer.start()
+        try:
+            self.timer.start()
+        finally:
+            if warmer:
+                warmer.stop()
+
+    def start_link_prober(self, sku_id):
+        """开始在后台轮询商品的抢购链接，已经开始时直接返回"""
+        prober = self.link_probers.get(sku_id)
+        if prober is None:
+            prober = LinkProber(self.session, self.timer, sku_id, self.user_agent, lead=self.link_lead,
+                                interval=self.link_interval, probes=self.link_probes)
+            self.link_probers[sku_id] = prober.start()
+        return prober
+
+    def stop_link_probers(self):
+        for prober in self.link_probers.values():
+            prober.stop()
+        self.link_probers.clear()
 
     def get_url(self):
-        url = 'https://itemko.jd.com/itemShowBtn'
-        payload = {
-            'callback': 'jQuery{}'.format(random.randint(1000000, 9999999)),
-            'skuId': self.sku_id,
-            'from': 'pc',
-            '_': str(int(time() * 1000)),
-        }
-        headers = {
-            'User-Agent': self.user_agent,
-            'Host': 'itemko.jd.com',
-            'Referer': 'https://item.jd.com/{}.html'.format(self.sku_id),
-        }
-        while True:
-            resp = self.session.get(url=url, headers=headers, params=payload)
-            resp_json = parse_json(resp.text)
-            if resp_json.get('url'):
-                # https://divide.jd.com/user_routing?skuId=8654289&sn=c3f4ececd8461f0e4d7267e96a91e0e0&from=pc
-                router_url = 'https:' + resp_json.get('url')
-                # https://marathon.jd.com/captcha.html?skuId=8654289&sn=c3f4ececd8461f0e4d7267e96a91e0e0&from=pc
-                pull_off_url = router_url.replace(
-                    'divide', 'marathon').replace(
-                    'user_routing', 'captcha.html')
-                logger.info("抢购链接获取成功: %s", pull_off_url)
+        """等待后台轮询获取到抢购链接，所有下单流程共用同一个链接"""
+        prober = self.start_link_prober(self.sku_id)
+        while not self.retry.finished():
+            pull_off_url = prober.wait(self.LINK_WAIT)
+            if pull_off_url:
                 return pull_off_url
-            else:
-                logger.info("抢购链接获取失败，稍后自动重试")
-                wait_some_time()
 
     def request_checkout_page(self):
         """访问抢购订单结算页面"""
@@ -406,7 +761,7 @@ class JDWrapper(object):
             'Host': 'marathon.jd.com',
             'Referer': 'https://item.jd.com/{}.html'.format(self.sku_id),
         }
-        self.session.get(url=url, params=payload, headers=headers, allow_redirects=False)
+        request_headers_only(self.session, 'GET', url, params=payload, headers=headers)
 
     def get_init_info(self):
         logger.info('获取秒杀初始化信息...')
@@ -424,21 +779,17 @@ class JDWrapper(object):
 
         resp_json = None
         try:
-            resp_json = parse_json(resp.text)
+            resp_json = parse_response(resp)
         except Exception:
             raise AsstException('抢购失败，返回信息:{}'.format(resp.text[0: 128]))
 
         return resp_json
 
-    def get_order_data(self):
-        logger.info('生成提交抢购订单所需参数...')
-        # 获取用户秒杀初始化信息
-        self.pull_off_init_info[self.sku_id] = self.get_init_info()
-        init_info = self.pull_off_init_info.get(self.sku_id)
+    def build_order_template(self, init_info):
+        """根据秒杀初始化信息生成订单模板，只包含地址、发票等不随每次提交变化的字段"""
         default_address = init_info['addressList'][0]  # 默认地址dict
         invoice_info = init_info.get('invoiceInfo', {})  # 默认发票信息dict, 有可能不返回
-        token = init_info['token']
-        data = {
+        return {
             'skuId': self.sku_id,
             'num': self.quantity,
             'addressId': default_address['id'],
@@ -462,28 +813,71 @@ class JDWrapper(object):
             'invoicePhone': invoice_info.get('invoicePhone', ''),
             'invoicePhoneKey': invoice_info.get('invoicePhoneKey', ''),
             'invoice': 'true' if invoice_info else 'false',
-            'password': global_config.get('account', 'payment_pwd'),
+            'password': self.payment_pwd,
             'codTimeType': 3,
             'paymentType': 4,
             'areaCode': '',
             'overseas': 0,
             'phone': '',
-            'eid': global_config.get('config', 'eid'),
-            'fp': global_config.get('config', 'fp'),
-            'token': token,
+            'eid': self.eid,
+            'fp': self.fp,
             'pru': ''
         }
+
+    def refresh_order_data(self):
+        """访问结算页面并重新获取秒杀初始化信息，更新订单模板及 token"""
+        logger.info('生成提交抢购订单所需参数...')
+        self.request_checkout_page()
+        # 获取用户秒杀初始化信息，多个流程同时获取时各自使用本次的结果，字典只作为缓存
+        init_info = self.get_init_info()
+        self.pull_off_init_info[self.sku_id] = init_info
+        if self.sku_id not in self.order_template:
+            self.order_template[self.sku_id] = self.build_order_template(init_info)
+        self.order_token[self.sku_id] = init_info['token']
+        return init_info['token']
+
+    def get_order_data(self, token=None):
+        """订单模板只生成一次，此后只在 token 失效时重新获取初始化信息
+        :param token: 指定本次提交使用的 token，流水线模式下由获取初始化信息的阶段预先取得
+        """
+        if token is None:
+            token = self.order_token.get(self.sku_id) or self.refresh_order_data()
+        data = dict(self.order_template[self.sku_id])
+        data['token'] = token
         return data
 
-    def submit_order(self):
+    def is_order_token_stale(self, resp_json):
+        if resp_json is None:
+            return True
+        message = str(resp_json.get('errorMessage', ''))
+        return any(keyword in message for keyword in self.ORDER_TOKEN_STALE_KEYWORDS)
+
+    def invalidate_order_token(self):
+        self.order_token.pop(self.sku_id, None)
+
+    def prefetch_order_data(self):
+        """购买时间前尝试预先获取订单模板，失败不影响抢购，触发后会重新获取"""
+        try:
+            self.refresh_order_data()
+            logger.info('已预先生成订单模板')
+        except Exception as e:
+            self.invalidate_order_token()
+            logger.info('预先生成订单模板失败，将在抢购开始后获取: %s', e)
+
+    def submit_order(self, token=None):
         url = 'https://marathon.jd.com/seckillnew/orderService/pc/submitOrder.action'
         payload = {
             'skuId': self.sku_id,
         }
         try:
-            self.order_data[self.sku_id] = self.get_order_data()
+            data = self.get_order_data(token)
         except Exception as e:
-            logger.info('抢购失败，无法获取生成订单的基本信息，接口返回:【{}】'.format(str(e)))
+            logger.info('抢购失败，无法获取生成订单的基本信息，接口返回:【%s】', e)
+            self.retry.record(None)
+            return False
+        self.order_data[self.sku_id] = data
+        if self.retry.outranked():
+            logger.info('商品%s优先级更高的商品已抢购成功，不再提交订单', self.sku_id)
             return False
 
         logger.info('提交抢购订单...')
@@ -493,17 +887,13 @@ class JDWrapper(object):
             'Referer': 'https://marathon.jd.com/seckill/seckill.action?skuId={0}&num={1}&rid={2}'.format(
                 self.sku_id, self.quantity, int(time())),
         }
-        resp = self.session.post(
-            url=url,
-            params=payload,
-            data=self.order_data.get(
-                self.sku_id),
-            headers=headers)
-        resp_json = None
-        try:
-            resp_json = parse_json(resp.text)
-        except Exception as e:
-            logger.info('抢购失败，返回信息:{}'.format(resp.text[0: 128]))
+        resp = self.session.post(url=url, params=payload, data=data, headers=headers)
+        # 只提取需要判断的字段，响应不是 JSON（如跳转到错误页面）时提取结果中没有 success
+        resp_json = parse_json_fields(resp.content, self.SUBMIT_RESULT_FIELDS)
+        if 'success' not in resp_json:
+            logger.info('抢购失败，返回信息:%s', resp.text[0: 128])
+            self.invalidate_order_token()
+            self.retry.record(None)
             return False
         # 返回信息
         # 抢购失败：
@@ -512,20 +902,22 @@ class JDWrapper(object):
         # {'errorMessage': '系统正在开小差，请重试~~', 'orderId': 0, 'resultCode': 90013, 'skuId': 0, 'success': False}
         # 抢购成功：
         # {"appUrl":"xxxxx","orderId":820227xxxxx,"pcUrl":"xxxxx","resultCode":0,"skuId":0,"success":true,"totalMoney":"xxxxx"}
-        if resp_json.get('success'):
+        if self.retry.record(resp_json) == SUCCESS:
             order_id = resp_json.get('orderId')
             total_money = resp_json.get('totalMoney')
             pay_url = 'https:' + resp_json.get('pcUrl')
-            logger.info('抢购成功，订单号:{}, 总价:{}, 电脑端付款链接:{}'.format(order_id, total_money, pay_url))
-            if global_config.getboolean('messenger', 'enable') == 'true':
+            logger.info('抢购成功，订单号:%s, 总价:%s, 电脑端付款链接:%s', order_id, total_money, pay_url)
+            if self.send_message:
                 success_message = "抢购成功，订单号:{}, 总价:{}, 电脑端付款链接:{}".format(order_id, total_money, pay_url)
-                self.send_message(success_message)
+                self.messenger.send(success_message)
             return True
         else:
-            logger.info('抢购失败，返回信息:{}'.format(resp_json))
-            if global_config.getboolean('messenger', 'enable') == 'true':
+            logger.info('抢购失败，返回信息:%s', resp_json)
+            if self.is_order_token_stale(resp_json):
+                self.invalidate_order_token()
+            if self.send_message:
                 error_message = '抢购失败，返回信息:{}'.format(resp_json)
-                self.send_message(error_message)
+                self.messenger.send_failure(error_message)
             return False
 
 
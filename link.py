@@ -0,0 +1,112 @@
+# -*- coding:utf-8 -*-
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from log import logger
+from utils import parse_json_fields
+
+ITEM_SHOW_BTN_URL = 'https://itemko.jd.com/itemShowBtn'
+
+
+def to_pull_off_url(router_url):
+    """itemShowBtn 返回的路由链接换成抢购链接
+    //divide.jd.com/user_routing?skuId=8654289&sn=c3f4ececd8461f0e4d7267e96a91e0e0&from=pc
+    -> https://marathon.jd.com/captcha.html?skuId=8654289&sn=c3f4ececd8461f0e4d7267e96a91e0e0&from=pc
+    """
+    return ('https:' + router_url).replace('divide', 'marathon').replace('user_routing', 'captcha.html')
+
+
+class LinkProber(object):
+    """抢先获取抢购链接
+
+    在购买时间前 lead 秒开始轮询 itemShowBtn，越接近购买时间轮询越密：
+    间隔为距离购买时间的 1/10，最长 MAX_INTERVAL 秒，最短 interval 秒，购买时间之后保持 interval。
+    最多同时有 probes 个请求在途（复用预热好的连接），全部在途时跳过本次轮询。
+    获取到链接后立即通过 wait 交给全部下单流程，并停止轮询。
+    """
+
+    MAX_INTERVAL = 0.3
+
+    def __init__(self, session, timer, sku_id, user_agent, lead=1, interval=0.02, probes=2, timeout=5):
+        self.session = session
+        self.timer = timer
+        self.sku_id = sku_id
+        self.user_agent = user_agent
+        self.lead = lead
+        self.interval = interval
+        self.probes = probes
+        self.timeout = timeout
+        self.url = None
+        self.attempts = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(probes)
+        self._found = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name='link-prober-{}'.format(self.sku_id), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def next_interval(self):
+        remaining = self.timer.remaining_ms() / 1000
+        return max(self.interval, min(self.MAX_INTERVAL, remaining / 10))
+
+    def _run(self):
+        delay = self.timer.remaining_ms() / 1000 - self.lead
+        if delay > 0 and self._stop.wait(delay):
+            return
+
+        logger.info('开始轮询商品%s的抢购链接，最多%s个请求同时在途', self.sku_id, self.probes)
+        with ThreadPoolExecutor(self.probes, thread_name_prefix='link-probe') as pool:
+            while not self._stop.is_set() and not self._found.is_set() and not self.timer.expired():
+                if self._slots.acquire(blocking=False):
+                    pool.submit(self.probe)
+                self._stop.wait(self.next_interval())
+
+    def probe(self):
+        payload = {
+            'callback': 'jQuery{}'.format(random.randint(1000000, 9999999)),
+            'skuId': self.sku_id,
+            'from': 'pc',
+            '_': str(int(time.time() * 1000)),
+        }
+        headers = {
+            'User-Agent': self.user_agent,
+            'Host': 'itemko.jd.com',
+            'Referer': 'https://item.jd.com/{}.html'.format(self.sku_id),
+        }
+        try:
+            with self._lock:
+                self.attempts += 1
+            resp = self.session.get(url=ITEM_SHOW_BTN_URL, headers=headers, params=payload, timeout=self.timeout)
+            router_url = parse_json_fields(resp.content, ('url',)).get('url')
+            if router_url:
+                self.found(to_pull_off_url(router_url))
+        except Exception as e:
+            logger.error('获取商品%s的抢购链接失败: %s', self.sku_id, e)
+        finally:
+            self._slots.release()
+
+    def found(self, pull_off_url):
+        with self._lock:
+            if self.url is not None:
+                return
+            self.url = pull_off_url
+        self._found.set()
+        logger.info('抢购链接获取成功（第%s次请求，购买时间后%.1f毫秒）: %s',
+                    self.attempts, -self.timer.remaining_ms(), pull_off_url)
+
+    def wait(self, timeout):
+        """等待抢购链接，超时返回 None"""
+        if self._found.wait(timeout):
+            return self.url
+        return None
@@ -1,26 +1,138 @@
 #!/usr/bin/env python
 # -*- encoding=utf8 -*-
+import atexit
 import logging
 import logging.handlers
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
 
 LOG_FILENAME = 'jd-logger.log'
 
 logger = logging.getLogger()
 
+_main_pid = os.getpid()
+_listener = None
+_queue_handler = None
+# set_logger 使用的配置快照，为 None 表示还没有配置日志；导入本模块不读取配置、不创建日志文件
+_settings = None
+# 本进程在进程池中的序号，由进程池的 initializer 通过 set_worker 设置
+_worker = None
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """写入有界队列的日志处理器
+
+    调用线程只负责入队，消息格式化与输出都由后台线程完成。
+    队列已满时 block 为 True 则等待（反压），否则丢弃该条日志并计数。
+    """
+
+    def __init__(self, log_queue, block=False):
+        super().__init__(log_queue)
+        self.block = block
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 同一进程内传递，不需要提前格式化
+        return record
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def log_filename():
+    """子进程写入各自的日志文件，避免多个进程同时写入及轮转同一个文件
+    进程池中的进程按序号命名，每次启动进程池（如常驻模式下每天一轮）都写入同一组文件；其他子进程按 pid 命名
+    """
+    if multiprocessing.parent_process() is None and os.getpid() == _main_pid:
+        return LOG_FILENAME
+    root, ext = os.path.splitext(LOG_FILENAME)
+    return '{}-{}{}'.format(root, os.getpid() if _worker is None else _worker, ext)
+
+
+def set_worker(index):
+    """在进程池的 initializer 中调用，已经设置过日志时按新的文件名重新设置"""
+    global _worker
+    _worker = index
+    if _settings is not None:
+        settings = _settings
+        stop_logger()
+        _remove_handlers()
+        set_logger(settings)
+
+
+def set_logger(settings):
+    """按配置快照设置日志输出，由 JDWrapper 在初始化时调用，已经设置过时直接返回"""
+    global _listener, _queue_handler, _settings
+    if _settings is not None:
+        return
+    _settings = settings
 
-def set_logger():
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(process)d-%(threadName)s - '
                                   '%(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s')
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
+    # 第一次写入时才创建文件，fork 后、set_worker 前的子进程不会留下按 pid 命名的空文件
     file_handler = logging.handlers.RotatingFileHandler(
-        LOG_FILENAME, maxBytes=10485760, backupCount=5, encoding="utf-8")
+        log_filename(), maxBytes=10485760, backupCount=5, encoding="utf-8", delay=True)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    if settings.log_mode != 'async':
+        logger.addHandler(console_handler)
+        logger.addHandler(file_handler)
+        return
+
+    _queue_handler = BoundedQueueHandler(queue.Queue(settings.log_queue_size),
+                                         block=settings.log_overflow == 'block')
+    logger.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, console_handler, file_handler)
+    _listener.start()
+
+
+def stop_logger():
+    """停止后台写日志线程，写完队列中剩余的日志"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    if _queue_handler.dropped:
+        for handler in _listener.handlers:
+            handler.handle(logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                             '日志队列已满，共丢弃%s条日志', (_queue_handler.dropped,), None))
+    _listener = None
+
+
+def _remove_handlers():
+    global _listener, _queue_handler, _settings
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    _settings = None
+    _listener = None
+    _queue_handler = None
+
+
+def _reset_after_fork():
+    # 子进程中没有父进程的后台写日志线程，丢弃继承来的处理器后重新创建
+    if _settings is None:
+        return
+    settings = _settings
+    _remove_handlers()
+    set_logger(settings)
 
 
-set_logger()
+atexit.register(stop_logger)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+    # multiprocessing 的子进程退出时不执行 atexit，改为注册其退出时的清理函数
+    multiprocessing.util.register_after_fork(
+        logger, lambda _: multiprocessing.util.Finalize(None, stop_logger, exitpriority=0))
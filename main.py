@@ -1,23 +1,41 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import sys
+import time
+
+started = time.perf_counter()
 
 from jd_auto_buy import JDWrapper
-import sys
+from log import logger
+
+imported = time.perf_counter()
 
 a = """
 功能列表：                                                                                
  1.预约商品
  2.秒杀抢购商品
+ 3.常驻运行，每天自动抢购（也可以使用 python main.py --daemon 启动）
 """
 
 if __name__ == '__main__':
-    print(a)
+    # 带参数启动时不再交互选择：python main.py 2 / python main.py --daemon
+    choice_function = sys.argv[1] if len(sys.argv) > 1 else None
+    if choice_function == '--daemon':
+        choice_function = '3'
+    if choice_function is None:
+        print(a)
     JDHelper = JDWrapper()  # 初始化
-    choice_function = input('请选择:')
+    logger.info('启动耗时：导入%.1f毫秒，初始化%.1f毫秒', (imported - started) * 1000, (time.perf_counter() - imported) * 1000)
+    if choice_function is None:
+        choice_function = input('请选择:')
     if choice_function == '1':
         JDHelper.reserve()
     elif choice_function == '2':
-        JDHelper.pull_off_proc_pool ()
+        JDHelper.prepare()
+        JDHelper.pull_off_start()
+    elif choice_function == '3':
+        JDHelper.prepare()
+        JDHelper.run_daemon()
     else:
         print('没有此功能')
         sys.exit(1)
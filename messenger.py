@@ -1,22 +1,77 @@
 #!/usr/bin/env python
 # -*- encoding=utf8 -*-
+import atexit
+import collections
 import datetime
 import json
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
 
 import requests
 
 from exception import AsstException
 from log import logger
 
+# 后台线程的控制消息
+_WAKE = object()
+_STOP = object()
+
 
 class Messenger(object):
-    """消息推送类"""
+    """消息推送类
+
+    send 只把消息放入队列后立即返回，由后台线程使用独立的 session（连接池）发送，不阻塞下单流程；
+    send_failure 的失败消息按内容合并计数，每隔 digest_interval 秒汇总为一条发送。
+    每轮抢购结束时调用 flush，进程退出时自动发送剩余消息。
+    """
+
+    URL = 'https://sc.ftqq.com/{}.send'
 
-    def __init__(self, sc_key):
+    def __init__(self, sc_key, timeout=5, digest_interval=60):
         if not sc_key:
             raise AsstException('sc_key can not be empty')
 
         self.sc_key = sc_key
+        self.timeout = timeout
+        self.digest_interval = digest_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._failures = collections.Counter()
+        self._first_failure = None
+        self._thread = None
+        self._session = None
+
+    def __getstate__(self):
+        # 队列、线程及 session 都属于当前进程，子进程中重新创建
+        return {'sc_key': self.sc_key, 'timeout': self.timeout, 'digest_interval': self.digest_interval}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            # fork 出的子进程中没有父进程的后台线程
+            self._reset()
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._session = requests.Session()
+            self._thread = threading.Thread(target=self._run, name='messenger', daemon=True)
+            self._thread.start()
+        # 主进程退出时执行 atexit；multiprocessing 的子进程不执行 atexit，改为注册其退出时的清理函数，
+        # 优先级高于日志的清理函数，保证发送结果还能写入日志
+        atexit.register(self.close)
+        multiprocessing.util.Finalize(None, self.close, exitpriority=10)
 
     def send(self, text, desp=''):
         if not text.strip():
@@ -25,11 +80,72 @@ class Messenger(object):
 
         now_time = str(datetime.datetime.now())
         desp = '[{0}]'.format(now_time) if not desp else '{0} [{1}]'.format(desp, now_time)
+        self._ensure_worker()
+        self._queue.put((text, desp))
+
+    def send_failure(self, text):
+        """失败消息不立即发送，合并到下一次汇总中"""
+        self._ensure_worker()
+        with self._lock:
+            self._failures[text] += 1
+            first = self._first_failure is None
+            if first:
+                self._first_failure = time.monotonic()
+        if first:
+            # 唤醒后台线程，按新的汇总时间等待
+            self._queue.put(_WAKE)
+
+    def flush(self, timeout=10):
+        """发送汇总及队列中的全部消息，等待发送完成"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        thread, self._thread = self._thread, None
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                first = self._first_failure
+            timeout = None if first is None else max(first + self.digest_interval - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._send_digest()
+                continue
+
+            if item is _WAKE:
+                continue
+            if item is _STOP or isinstance(item, threading.Event):
+                self._send_digest()
+                if item is _STOP:
+                    self._session.close()
+                    return
+                item.set()
+                continue
+            self._deliver(*item)
+
+    def _send_digest(self):
+        with self._lock:
+            failures, self._failures = self._failures, collections.Counter()
+            self._first_failure = None
+        if not failures:
+            return
+        text = '抢购失败{}次'.format(sum(failures.values()))
+        desp = '\n\n'.join('{} × {}'.format(message, count) for message, count in failures.most_common(10))
+        self._deliver(text, '{} [{}]'.format(desp, datetime.datetime.now()))
 
+    def _deliver(self, text, desp):
         try:
-            resp = requests.get(
-                'https://sc.ftqq.com/{}.send?text={}&desp={}'.format(self.sc_key, text, desp)
-            )
+            resp = self._session.get(self.URL.format(self.sc_key), params={'text': text, 'desp': desp},
+                                     timeout=self.timeout)
             resp_json = json.loads(resp.text)
             if resp_json.get('errno') == 0:
                 logger.info('Message sent successfully [text: %s, desp: %s]', text, desp)
@@ -0,0 +1,387 @@
+# -*- coding:utf-8 -*-
+"""
+本地模拟京东服务器
+实现抢购流程用到的全部接口，可配置延迟、抖动、错误码及售罄时间，用于离线测试与性能基准
+
+单独运行：python mock_server.py --port 8899 --open-after 10
+然后在 config.ini 中设置 mock_server = http://127.0.0.1:8899
+"""
+import argparse
+import hashlib
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from requests.adapters import HTTPAdapter
+
+
+class MockOptions(object):
+    """模拟服务器的行为参数，时间单位均为毫秒"""
+
+    def __init__(self, latency=20, jitter=5, clock_skew=0, open_after=3000, win_after=None, stock=1,
+                 sell_out_after=None, rate_limit_ratio=0.1, busy_ratio=0.1, qr_scan_after=2):
+        self.latency = latency
+        self.jitter = jitter
+        # 服务器时间比本地时间快多少毫秒
+        self.clock_skew = clock_skew
+        # 启动后多久开放抢购（itemShowBtn 返回抢购链接）
+        self.open_after = open_after
+        # 开放抢购后多久开始可以下单成功，None 表示开放后立即可以成功
+        self.win_after = win_after
+        # 可成功下单的数量，用完即售罄
+        self.stock = stock
+        # 开放抢购后多久售罄，None 表示只受库存限制
+        self.sell_out_after = sell_out_after
+        # 提交订单返回 60017（提交过快）和 90013（开小差）的比例
+        self.rate_limit_ratio = rate_limit_ratio
+        self.busy_ratio = busy_ratio
+        # 轮询二维码状态多少次后视为扫码确认
+        self.qr_scan_after = qr_scan_after
+
+
+def make_png(width, height, pixels):
+    """生成 8 位灰度 PNG，pixels 为按行排列的 0/1 列表，1 为黑色"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    raw = b''.join(b'\x00' + bytes(0 if pixels[y * width + x] else 255 for x in range(width))
+                   for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端读完响应头即断开（流式读取、只读响应头的请求）属于正常情况
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockJDServer(object):
+
+    def __init__(self, options=None, host='127.0.0.1', port=0):
+        self.options = options or MockOptions()
+        self.started = time.time() * 1000
+        self.sold = 0
+        self.qr_polls = 0
+        self.counters = dict()
+        self._lock = threading.Lock()
+        self._areas = None
+
+        handler = type('Handler', (MockHandler,), {'mock': self})
+        self.httpd = QuietHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='mock-jd-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def areas(self):
+        """地区接口的数据：父节点 id -> 子节点列表，来自 area_id/*.txt，第一次请求时加载"""
+        with self._lock:
+            if self._areas is None:
+                from area import load_source
+
+                areas = dict()
+
+                def walk(nodes):
+                    for name, area_id, children in nodes:
+                        if children:
+                            areas[area_id] = [{'id': child[1], 'name': child[0]} for child in children]
+                            walk(children)
+
+                walk(load_source())
+                self._areas = areas
+            return self._areas
+
+    def since_open(self):
+        return time.time() * 1000 - self.started - self.options.open_after
+
+    def server_time(self):
+        return int(time.time() * 1000 + self.options.clock_skew)
+
+    def submit_result(self):
+        options = self.options
+        since_open = self.since_open()
+        with self._lock:
+            sold_out = self.sold >= options.stock or (
+                options.sell_out_after is not None and since_open >= options.sell_out_after)
+            if sold_out:
+                return 60074
+            ratio = random.random()
+            if ratio < options.rate_limit_ratio:
+                return 60017
+            # 未开放或未到 win_after 时返回系统繁忙，客户端会立即重试
+            if ratio < options.rate_limit_ratio + options.busy_ratio or since_open < 0 or (
+                    options.win_after is not None and since_open < options.win_after):
+                return 90013
+            self.sold += 1
+            return 0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = 'HTTP/1.1'
+
+    RESULT_MESSAGES = {
+        60074: '很遗憾没有抢到，再接再厉哦。',
+        60017: '抱歉，您提交过快，请稍后再提交订单！',
+        90013: '系统正在开小差，请重试~~',
+    }
+
+    def setup(self):
+        super().setup()
+        # 响应头与响应体分开写出，关闭 Nagle 算法避免与客户端的延迟确认叠加出 40ms 的额外延迟
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.reply(200, b'', head=True)
+
+    def dispatch(self):
+        options = self.mock.options
+        delay = options.latency + random.gauss(0, options.jitter) if options.jitter else options.latency
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        host = self.headers.get('Host', '').split(':')[0]
+        # 路径可能以 // 开头（如 queryServerData），不能交给 urlsplit 解析
+        path, _, query_string = self.path.partition('?')
+        query = {key: values[0] for key, values in parse_qs(query_string).items()}
+        name = host + path
+        self.mock.count(name)
+        route = self.ROUTES.get(name)
+        if route is None and host == 'item.jd.com':
+            route = MockHandler.item_page
+        if route is None:
+            self.reply(404, b'not found')
+            return
+        route(self, query)
+
+    def reply(self, status, body, content_type='text/html; charset=utf-8', headers=None, head=False):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def reply_json(self, data, callback=None):
+        body = json.dumps(data, ensure_ascii=False)
+        if callback:
+            body = '{}({});'.format(callback, body)
+        self.reply(200, body, 'application/json; charset=utf-8')
+
+    def server_data(self, query):
+        self.reply_json({'serverTime': self.mock.server_time()})
+
+    def item_show_btn(self, query):
+        if self.mock.since_open() < 0:
+            self.reply_json({}, query.get('callback'))
+            return
+        self.reply_json({'url': '//divide.jd.com/user_routing?skuId={}&sn={}&from=pc'.format(
+            query.get('skuId'), uuid.uuid4().hex)}, query.get('callback'))
+
+    def captcha(self, query):
+        self.reply(302, b'', headers={'Location': 'https://marathon.jd.com/seckill/seckill.action',
+                                      'Set-Cookie': 'seckillSid={}; Path=/'.format(uuid.uuid4().hex)})
+
+    def seckill(self, query):
+        self.reply(302, b'', headers={'Location': 'https://marathon.jd.com/seckillM/seckill.action'})
+
+    def init_info(self, query):
+        self.reply_json({
+            'addressList': [{
+                'id': 1, 'name': 'mock', 'provinceId': 1, 'cityId': 72, 'countyId': 2799, 'townId': 0,
+                'addressDetail': 'mock address', 'mobile': '138****0000', 'mobileKey': 'mock', 'email': '',
+            }],
+            'invoiceInfo': {'invoiceTitle': 4, 'invoiceContentType': 1, 'invoicePhone': '', 'invoicePhoneKey': ''},
+            'token': uuid.uuid4().hex,
+        })
+
+    def submit_order(self, query):
+        code = self.mock.submit_result()
+        if code:
+            self.reply_json({'errorMessage': self.RESULT_MESSAGES[code], 'orderId': 0, 'resultCode': code,
+                             'skuId': 0, 'success': False})
+        else:
+            self.reply_json({'appUrl': '//mock', 'orderId': random.randint(10 ** 11, 10 ** 12), 'pcUrl': '//mock',
+                             'resultCode': 0, 'skuId': 0, 'success': True, 'totalMoney': '1499.00'})
+
+    def reserve_info(self, query):
+        self.reply_json({'url': '//yushou.jd.com/toYuyue.action?sku={}'.format(query.get('sku'))},
+                        query.get('callback'))
+
+    def reserve(self, query):
+        self.reply(200, '<html><head><title>预约成功</title></head></html>')
+
+    def item_page(self, query):
+        head = '<html><head><meta charset="utf-8"><title>【京东】模拟商品{}</title></head>'.format(
+            self.path.strip('/').split('.')[0])
+        self.reply(200, head + '<body>' + 'x' * 200000 + '</body></html>')
+
+    def login_page(self, query):
+        self.reply(200, '<html></html>', headers={'Set-Cookie': 'wlfstk_smdl={}; Path=/'.format(uuid.uuid4().hex)})
+
+    def qr_show(self, query):
+        # 21x21 模块，三个角为定位图案及其外侧一圈空白分隔，其余随机；每个模块 scale 像素，四周留 quiet 个模块的空白
+        size, scale, quiet = 21, 4, 4
+
+        def module(i, j):
+            for top, left in ((0, 0), (0, size - 7), (size - 7, 0)):
+                y, x = i - top, j - left
+                if -1 <= y <= 7 and -1 <= x <= 7:
+                    return int(0 <= y <= 6 and 0 <= x <= 6 and (y in (0, 6) or x in (0, 6) or (
+                        2 <= y <= 4 and 2 <= x <= 4)))
+            return random.randint(0, 1)
+
+        matrix = [[module(i, j) for j in range(size)] for i in range(size)]
+        width = (size + quiet * 2) * scale
+        pixels = [0] * (width * width)
+        for i in range(size):
+            for j in range(size):
+                if matrix[i][j]:
+                    for y in range((i + quiet) * scale, (i + quiet + 1) * scale):
+                        pixels[y * width + (j + quiet) * scale:y * width + (j + quiet + 1) * scale] = [1] * scale
+        self.reply(200, make_png(width, width, pixels), 'image/png')
+
+    def qr_check(self, query):
+        self.mock.qr_polls += 1
+        if self.mock.qr_polls < self.mock.options.qr_scan_after:
+            data = {'code': 201, 'msg': '二维码未扫描 ，请扫描二维码'}
+        elif self.mock.qr_polls == self.mock.options.qr_scan_after:
+            data = {'code': 202, 'msg': '请手机客户端确认登录'}
+        else:
+            data = {'code': 200, 'msg': '', 'ticket': uuid.uuid4().hex}
+        self.reply_json(data, query.get('callback'))
+
+    def qr_validate(self, query):
+        self.reply_json({'returnCode': 0, 'url': ''})
+
+    def user_info(self, query):
+        self.reply_json({'nickName': 'mock'}, query.get('callback'))
+
+    def order_list(self, query):
+        self.reply(200, '<html></html>')
+
+    def area_get(self, query):
+        body = json.dumps(self.mock.areas().get(int(query.get('fid', 0)), []), ensure_ascii=False).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, b'', headers={'ETag': etag})
+        else:
+            self.reply(200, body, 'application/json; charset=utf-8', headers={'ETag': etag})
+
+    ROUTES = {
+        'a.jd.com//ajax/queryServerData.html': server_data,
+        'a.jd.com/ajax/queryServerData.html': server_data,
+        'itemko.jd.com/itemShowBtn': item_show_btn,
+        'marathon.jd.com/captcha.html': captcha,
+        'marathon.jd.com/seckill/seckill.action': seckill,
+        'marathon.jd.com/seckillnew/orderService/pc/init.action': init_info,
+        'marathon.jd.com/seckillnew/orderService/pc/submitOrder.action': submit_order,
+        'yushou.jd.com/youshouinfo.action': reserve_info,
+        'yushou.jd.com/toYuyue.action': reserve,
+        'passport.jd.com/new/login.aspx': login_page,
+        'qr.m.jd.com/show': qr_show,
+        'qr.m.jd.com/check': qr_check,
+        'passport.jd.com/uc/qrCodeTicketValidation': qr_validate,
+        'passport.jd.com/user/petName/getUserInfoForMiniJd.action': user_info,
+        'order.jd.com/center/list.action': order_list,
+        'd.jd.com/area/get': area_get,
+    }
+
+
+class MockAdapter(HTTPAdapter):
+    """把发往京东各域名的请求转发到模拟服务器，Host 头保留原域名用于路由
+
+    转发时复制请求对象，session 仍按原始 URL 保存 cookie。
+    """
+
+    # 多进程抢购时 session 随 JDWrapper 一起序列化，HTTPAdapter 只保留 __attrs__ 中的属性
+    __attrs__ = HTTPAdapter.__attrs__ + ['server_url']
+
+    def __init__(self, server_url, **kwargs):
+        self.server_url = server_url.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        proxied = request.copy()
+        proxied.url = self.server_url + request.url[len(parts.scheme) + 3 + len(parts.netloc):]
+        proxied.headers['Host'] = parts.hostname
+        resp = super().send(proxied, **kwargs)
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟京东服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--latency', type=float, default=20, help='接口延迟（毫秒）')
+    parser.add_argument('--jitter', type=float, default=5, help='延迟抖动标准差（毫秒）')
+    parser.add_argument('--clock-skew', type=float, default=0, help='服务器时间偏移（毫秒）')
+    parser.add_argument('--open-after', type=float, default=10, help='启动后多少秒开放抢购')
+    parser.add_argument('--win-after', type=float, default=None, help='开放后多少秒可以下单成功')
+    parser.add_argument('--stock', type=int, default=1, help='库存数量')
+    parser.add_argument('--sell-out-after', type=float, default=None, help='开放后多少秒售罄')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.1, help='返回 60017 的比例')
+    parser.add_argument('--busy-ratio', type=float, default=0.1, help='返回 90013 的比例')
+    args = parser.parse_args()
+
+    options = MockOptions(
+        latency=args.latency, jitter=args.jitter, clock_skew=args.clock_skew, open_after=args.open_after * 1000,
+        win_after=None if args.win_after is None else args.win_after * 1000, stock=args.stock,
+        sell_out_after=None if args.sell_out_after is None else args.sell_out_after * 1000,
+        rate_limit_ratio=args.rate_limit_ratio, busy_ratio=args.busy_ratio)
+    server = MockJDServer(options, args.host, args.port)
+    print('模拟京东服务器已启动：{}'.format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
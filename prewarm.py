@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib3.util.connection import allowed_gai_family
+
+from log import logger
+
+# 抢购关键路径上依次访问的域名：获取抢购链接、抢购链接跳转、结算及提交订单
+HOT_HOSTS = ('itemko.jd.com', 'divide.jd.com', 'marathon.jd.com')
+
+
+class DNSCache(object):
+    """进程内 DNS 缓存
+    安装后替换 socket.getaddrinfo，命中缓存的域名不再发起解析
+    """
+
+    def __init__(self):
+        self.cache = dict()
+        self._getaddrinfo = None
+
+    def resolve(self, host, port=443):
+        getaddrinfo = self._getaddrinfo or socket.getaddrinfo
+        # 与 urllib3 建立连接时的参数保持一致，保证能够命中缓存；不支持 IPv6 的环境中 urllib3 使用 AF_INET
+        family = allowed_gai_family()
+        result = getaddrinfo(host, port, family, socket.SOCK_STREAM)
+        self.cache[(host, port, family, socket.SOCK_STREAM)] = result
+        return result
+
+    def install(self):
+        if self._getaddrinfo is not None:
+            return
+        self._getaddrinfo = socket.getaddrinfo
+
+        def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+            result = self.cache.get((host, port, family, type))
+            if result is not None and not proto and not flags:
+                return result
+            return self._getaddrinfo(host, port, family, type, proto, flags)
+
+        socket.getaddrinfo = getaddrinfo
+
+    def uninstall(self):
+        if self._getaddrinfo is not None:
+            socket.getaddrinfo = self._getaddrinfo
+            self._getaddrinfo = None
+
+
+class ConnectionWarmer(object):
+    """抢购前预热连接池
+
+    在购买时间前 prewarm_seconds 秒开始：解析并缓存 DNS，对每个域名并发建立 pool_size 个长连接，
+    之后每隔 keepalive_interval 秒用 HEAD 请求保活，直到触发时间到达，
+    使抢购请求只复用已经完成握手的连接。
+    """
+
+    def __init__(self, session, timer, hosts=HOT_HOSTS, pool_size=10, prewarm_seconds=30,
+                 keepalive_interval=10, resolve_dns=True):
+        self.session = session
+        self.timer = timer
+        self.hosts = hosts
+        self.pool_size = pool_size
+        self.prewarm_seconds = prewarm_seconds
+        self.keepalive_interval = keepalive_interval
+        self.resolve_dns = resolve_dns
+        self.dns_cache = DNSCache()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.timer.remaining_ms() <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='connection-warmer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """触发时间到达后调用；恢复 socket.getaddrinfo，下一轮重新解析，避免一直使用第一次解析的结果"""
+        self._stop.set()
+        self._thread = None
+        self.dns_cache.uninstall()
+
+    def _run(self):
+        delay = self.timer.remaining_ms() / 1000 - self.prewarm_seconds
+        if delay > 0 and self._stop.wait(delay):
+            return
+
+        logger.info('开始预热连接池：%s，每个域名%s个连接', ', '.join(self.hosts), self.pool_size)
+        if self.resolve_dns:
+            self.dns_cache.install()
+        try:
+            with ThreadPoolExecutor(self.pool_size * len(self.hosts)) as pool:
+                while not self._stop.is_set():
+                    self.warm(pool)
+                    remaining = self.timer.remaining_ms() / 1000
+                    # 保活请求不能与触发时刻重叠
+                    if self._stop.wait(max(min(self.keepalive_interval, remaining - 1), 0)) or remaining <= 1:
+                        break
+        finally:
+            # stop 之后才安装完成的情况
+            if self._stop.is_set():
+                self.dns_cache.uninstall()
+
+    def warm(self, pool):
+        begin = time.perf_counter()
+        for host in self.hosts if self.resolve_dns else ():
+            try:
+                self.dns_cache.resolve(host)
+            except OSError as e:
+                logger.error('解析域名%s失败: %s', host, e)
+
+        # 同一域名的请求并发发出，连接池才会为其各自建立连接并在结束后全部保留
+        futures = [pool.submit(self.touch, host) for host in self.hosts for _ in range(self.pool_size)]
+        ok = sum(1 for future in futures if future.result())
+        logger.info('连接池预热完成：%s/%s 个连接可用，耗时%.1f毫秒',
+                    ok, len(futures), (time.perf_counter() - begin) * 1000)
+
+    def touch(self, host):
+        try:
+            self.session.head('https://{}/'.format(host), allow_redirects=False, timeout=5)
+            return True
+        except Exception as e:
+            logger.error('预热连接%s失败: %s', host, e)
+            return False
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+import re
+import threading
+import time
+
+from log import logger
+
+CHARSET_PATTERN = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def header_charset(resp):
+    """响应头 Content-Type 中声明的编码，没有声明时返回 None
+    不使用 resp.encoding：没有声明编码的 text/html 会被 requests 当作 ISO-8859-1
+    """
+    match = CHARSET_PATTERN.search(resp.headers.get('Content-Type', ''))
+    return match.group(1) if match else None
+
+
+class ProductMeta(object):
+    """商品页面头部信息获取
+
+    以流式方式读取商品页面，边下载边增量解析，读到 </head>（或 <body> 开始）即停止下载，
+    不构建整页 DOM。结果按商品id缓存 ttl 秒。
+    """
+
+    META_NAMES = ('keywords', 'description')
+
+    def __init__(self, session, ttl=3600, chunk_size=4096, timeout=5):
+        self.session = session
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.cache = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, sku_id):
+        with self._lock:
+            cached = self.cache.get(sku_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        meta = self.fetch(sku_id)
+        with self._lock:
+            self.cache[sku_id] = (time.monotonic() + self.ttl, meta)
+        return meta
+
+    def fetch(self, sku_id):
+        url = 'https://item.jd.com/{}.html'.format(sku_id)
+        # lxml 导入较慢，只在确实需要读取商品页面时导入
+        from lxml import etree
+
+        meta = {'title': ''}
+        received = 0
+        resp = self.session.get(url, stream=True, timeout=self.timeout)
+        try:
+            # 响应头没有声明编码时交给 libxml2 根据 <meta charset> 识别
+            parser = etree.HTMLPullParser(events=('start', 'end'), encoding=header_charset(resp))
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                received += len(chunk)
+                parser.feed(chunk)
+                if self._read_events(parser, meta):
+                    break
+        finally:
+            # 未读完的响应体直接丢弃，连接不再复用
+            resp.close()
+        logger.info('商品%s页面头部信息读取完成，下载%s字节', sku_id, received)
+        return meta
+
+    def _read_events(self, parser, meta):
+        """处理已解析出的元素，head 结束时返回 True"""
+        for event, element in parser.read_events():
+            tag = element.tag
+            if event == 'end' and tag == 'title':
+                meta['title'] = (element.text or '').strip()
+            elif event == 'end' and tag == 'meta' and element.get('name') in self.META_NAMES:
+                meta[element.get('name')] = element.get('content', '')
+            elif (event == 'end' and tag == 'head') or (event == 'start' and tag == 'body'):
+                return True
+        return False
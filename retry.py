@@ -0,0 +1,211 @@
+# -*- coding:utf-8 -*-
+import multiprocessing
+import random
+import threading
+import time
+
+from log import logger, set_worker
+
+SUCCESS = 'success'
+RATE_LIMIT = 'rate_limit'
+TRANSIENT = 'transient'
+SOLD_OUT = 'sold_out'
+ERROR = 'error'
+EXPIRED = 'expired'
+CANCELLED = 'cancelled'
+
+
+class StopSignal(object):
+    """进程池中各进程共享的停止信号
+
+    结果、获胜进程及时间保存在共享内存中，读取不加锁，各进程在每次提交前检查；
+    退避等待中的进程通过 Event 立即唤醒。只能通过进程池的 initializer 传给子进程。
+    """
+
+    OUTCOMES = (None, SUCCESS, SOLD_OUT, EXPIRED)
+
+    def __init__(self, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        self._outcome = ctx.RawValue('i', 0)
+        self._winner = ctx.RawValue('i', -1)
+        self._time = ctx.RawValue('d', 0)
+        # 已启动的进程数，用于给进程池中的进程分配序号
+        self._workers = ctx.RawValue('i', 0)
+        self._lock = ctx.Lock()
+        self._event = ctx.Event()
+
+    def publish(self, outcome, worker):
+        """只记录第一个结束原因，成功可以覆盖其他原因；返回是否由本次调用记录"""
+        with self._lock:
+            if self._outcome.value and (outcome != SUCCESS or self.outcome == SUCCESS):
+                return False
+            self._outcome.value = self.OUTCOMES.index(outcome)
+            self._winner.value = worker
+            self._time.value = time.time()
+        self._event.set()
+        return True
+
+    def next_worker(self):
+        with self._lock:
+            index = self._workers.value
+            self._workers.value += 1
+        return index
+
+    @property
+    def outcome(self):
+        return self.OUTCOMES[self._outcome.value]
+
+    @property
+    def winner(self):
+        return self._winner.value
+
+    @property
+    def time(self):
+        return self._time.value
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+_signal = None
+
+
+def install_signal(signal):
+    """进程池 initializer，保存停止信号供本进程的 RetryController 使用，并按进程序号设置日志文件"""
+    global _signal
+    _signal = signal
+    set_worker(signal.next_worker())
+
+
+def current_signal():
+    return _signal
+
+
+class RetryController(object):
+    """根据提交订单的返回结果决定下一次提交的时机
+
+    60017（提交过快）：所有下单流程一起退避，连续限流时退避时间加倍，直到 backoff_max；
+    90013（系统开小差）：立即重试；
+    60074（没有抢到）或下单成功：停止全部下单流程；
+    其他失败及请求异常：按原来的方式随机等待 100~300 毫秒后重试。
+    超过最后购买时间同样停止。同一进程内的下单流程共享一个实例，
+    多进程时通过 attach 关联 StopSignal，任一进程结束即通知全部进程。
+    多个商品同时抢购时 higher 为优先级更高的商品的实例，其中任一抢购成功即停止本商品。
+    """
+
+    RATE_LIMIT_CODES = (60017,)
+    TRANSIENT_CODES = (90013,)
+    SOLD_OUT_CODES = (60074,)
+
+    def __init__(self, timer, backoff_base=0.1, backoff_max=2.0):
+        self.timer = timer
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self.signal = None
+        self.worker = None
+        self.higher = ()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['signal'] = None
+        return state
+
+    def attach(self, signal, worker):
+        self.signal = signal
+        self.worker = worker
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """每一轮抢购开始前调用"""
+        self.backoff = 0
+        self.resume_at = 0
+        self.outcome = None
+        self.counts = dict.fromkeys((SUCCESS, RATE_LIMIT, TRANSIENT, SOLD_OUT, ERROR), 0)
+
+    def classify(self, resp_json):
+        if resp_json.get('success'):
+            return SUCCESS
+        code = resp_json.get('resultCode')
+        if code in self.RATE_LIMIT_CODES:
+            return RATE_LIMIT
+        if code in self.TRANSIENT_CODES:
+            return TRANSIENT
+        if code in self.SOLD_OUT_CODES:
+            return SOLD_OUT
+        return ERROR
+
+    def record(self, resp_json):
+        """记录一次提交订单的返回结果，resp_json 为 None 表示请求失败或返回内容无法解析"""
+        result = ERROR if resp_json is None else self.classify(resp_json)
+        now = time.monotonic()
+        with self._lock:
+            self.counts[result] += 1
+            if result == RATE_LIMIT:
+                self.backoff = min(self.backoff * 2 or self.backoff_base, self.backoff_max)
+                # 加入抖动，避免所有下单流程在同一时刻恢复
+                self.resume_at = max(self.resume_at, now + self.backoff * random.uniform(0.5, 1))
+                return result
+            self.backoff = 0
+            if result == ERROR:
+                self.resume_at = max(self.resume_at, now + random.randint(100, 300) / 1000)
+            elif result == SUCCESS or (result == SOLD_OUT and self.outcome is None):
+                # 停止后仍在途的请求可能下单成功，成功优先于其他结束原因
+                self.outcome = result
+        if self.signal is not None and result in (SUCCESS, SOLD_OUT):
+            self.signal.publish(result, self.worker)
+        return result
+
+    def cancel(self):
+        """停止本控制器的全部下单流程（多个商品同时抢购时，优先级更高的商品已抢购成功）"""
+        with self._lock:
+            if self.outcome is None:
+                self.outcome = CANCELLED
+
+    def outranked(self):
+        """优先级更高的商品是否已抢购成功，提交订单前检查，是则停止本商品"""
+        if any(controller.outcome == SUCCESS for controller in self.higher):
+            self.cancel()
+            return True
+        return False
+
+    def delay(self):
+        """下一次提交前需要等待的秒数"""
+        return max(self.resume_at - time.monotonic(), 0)
+
+    def sleep(self, seconds):
+        """退避等待，其他进程发出停止信号时立即返回"""
+        if seconds <= 0:
+            return
+        if self.signal is not None:
+            self.signal.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    def finished(self):
+        if self.outcome is None and not self.outranked():
+            if self.signal is not None and self.signal.outcome is not None:
+                self.outcome = self.signal.outcome
+            elif self.timer.expired():
+                self.outcome = EXPIRED
+                if self.signal is not None:
+                    self.signal.publish(EXPIRED, self.worker)
+        return self.outcome is not None
+
+    def reason(self):
+        return {
+            SUCCESS: '抢购成功',
+            SOLD_OUT: '商品已抢完',
+            EXPIRED: '已过最后购买时间{}'.format(self.timer.last_purchase_time),
+            CANCELLED: '优先级更高的商品已抢购成功，停止抢购',
+        }.get(self.outcome, '抢购结束')
+
+    def report(self, prefix=''):
+        logger.info('%s%s，提交订单结果统计：成功%s次，限流%s次，系统繁忙%s次，没有抢到%s次，其他失败%s次',
+                    prefix, self.reason(), self.counts[SUCCESS], self.counts[RATE_LIMIT], self.counts[TRANSIENT],
+                    self.counts[SOLD_OUT], self.counts[ERROR])
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+"""
+在终端中显示登录二维码
+纯 Python 解码 PNG（zlib 解压 + 逐行反滤波），识别二维码模块大小后按模块采样，
+用上下半块字符加 ANSI 颜色输出，每个字符显示上下两个模块，无需图片查看器
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 各颜色类型每个像素的通道数
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def read_chunks(data):
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('不是 PNG 图片')
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        yield kind, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def unfilter(raw, height, stride, bpp):
+    """按每行开头的滤波类型还原像素数据，bpp 为每个像素的字节数（不足 1 字节按 1 计算）"""
+    rows = []
+    prev = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        kind = raw[pos]
+        line = bytearray(raw[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if kind == 1:
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xff
+        elif kind == 2:
+            for i in range(stride):
+                line[i] = (line[i] + prev[i]) & 0xff
+        elif kind == 3:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prev[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                up_left = prev[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + paeth(left, prev[i], up_left)) & 0xff
+        elif kind != 0:
+            raise ValueError('不支持的 PNG 滤波类型: {}'.format(kind))
+        rows.append(line)
+        prev = line
+    return rows
+
+
+def decode_png(data):
+    """解码 PNG 为灰度像素
+    :return: (width, height, rows)，rows 为每行 0~255 灰度值的列表
+    """
+    header = None
+    palette = None
+    idat = []
+    for kind, body in read_chunks(data):
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif kind == b'PLTE':
+            palette = [body[i:i + 3] for i in range(0, len(body), 3)]
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+    if header is None:
+        raise ValueError('PNG 缺少 IHDR')
+
+    width, height, depth, color_type, _, _, interlace = header
+    if color_type not in CHANNELS or interlace:
+        raise ValueError('不支持的 PNG 格式: 颜色类型{}，隔行扫描{}'.format(color_type, interlace))
+    if depth not in (1, 2, 4, 8):
+        raise ValueError('不支持的 PNG 位深: {}'.format(depth))
+
+    channels = CHANNELS[color_type]
+    stride = (width * channels * depth + 7) // 8
+    rows = unfilter(zlib.decompress(b''.join(idat)), height, stride, max(channels * depth // 8, 1))
+
+    gray = []
+    for line in rows:
+        if depth < 8:
+            mask = (1 << depth) - 1
+            values = [(line[x * depth // 8] >> (8 - depth - x * depth % 8)) & mask for x in range(width)]
+            if color_type == 0:
+                values = [v * 255 // mask for v in values]
+        else:
+            values = [line[x * channels:(x + 1) * channels] for x in range(width)]
+            if color_type in (0, 4):
+                values = [v[0] for v in values]
+            elif color_type in (2, 6):
+                values = [(v[0] * 299 + v[1] * 587 + v[2] * 114) // 1000 for v in values]
+            else:
+                values = [v[0] for v in values]
+        if color_type == 3:
+            values = [(palette[v][0] * 299 + palette[v][1] * 587 + palette[v][2] * 114) // 1000 for v in values]
+        gray.append(values)
+    return width, height, gray
+
+
+def qr_modules(width, height, gray, threshold=128):
+    """识别二维码的模块大小并按模块中心采样
+    左上角定位图案最上面一行是连续 7 个深色模块，以此计算模块的像素大小
+    :return: 模块矩阵，True 为深色
+    """
+    dark = [[value < threshold for value in row] for row in gray]
+    points = [(y, x) for y in range(height) for x in range(width) if dark[y][x]]
+    if not points:
+        raise ValueError('图片中没有二维码')
+    top = min(y for y, _ in points)
+    bottom = max(y for y, _ in points)
+    left = min(x for _, x in points)
+    right = max(x for _, x in points)
+
+    run = 0
+    while left + run <= right and dark[top][left + run]:
+        run += 1
+    module = max(run / 7, 1)
+    size = max(int(round((right - left + 1) / module)), 1)
+    rows = max(int(round((bottom - top + 1) / module)), 1)
+    return [[dark[min(top + int((i + 0.5) * module), bottom)][min(left + int((j + 0.5) * module), right)]
+             for j in range(size)] for i in range(rows)]
+
+
+def render(matrix, quiet=2):
+    """每个字符显示上下两个模块：前景色为上方模块，背景色为下方模块"""
+    size = len(matrix[0])
+    blank = [False] * (size + quiet * 2)
+    padded = [blank] * quiet + [[False] * quiet + row + [False] * quiet for row in matrix] + [blank] * quiet
+    if len(padded) % 2:
+        padded.append(blank)
+    lines = []
+    for upper, lower in zip(padded[0::2], padded[1::2]):
+        cells = ''.join('\033[{};{}m▀'.format(30 if a else 97, 40 if b else 107) for a, b in zip(upper, lower))
+        lines.append(cells + '\033[0m')
+    return '\n'.join(lines)
+
+
+def render_png(data):
+    """图片损坏（如下载不完整）或格式不支持时统一抛出 ValueError"""
+    try:
+        return render(qr_modules(*decode_png(data)))
+    except (zlib.error, struct.error, IndexError, KeyError, TypeError) as e:
+        raise ValueError('PNG 图片损坏: {!r}'.format(e)) from e
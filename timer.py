@@ -1,76 +1,315 @@
 # -*- coding:utf-8 -*-
 import time
+import threading
 import requests
 import json
 
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
+from exception import AsstException
 from log import logger
+from tracing import tracer, TracedSession
 
-from config import global_config
+from config import get_settings
+from variables import DEFAULT_TIMEOUT
 
 
 def local_time():
     return int(round(time.time() * 1000))
 
 
+JD_TIME_URL = 'https://a.jd.com//ajax/queryServerData.html'
+
+
 def jd_time():
-    url = 'https://a.jd.com//ajax/queryServerData.html'
-    ret = requests.get(url).text
+    ret = requests.get(JD_TIME_URL).text
     js = json.loads(ret)
     return int(js["serverTime"])
 
 
+def jd_time_sample(session=None, timeout=DEFAULT_TIMEOUT):
+    """对京东服务器时间做一次采样
+    按 NTP 的方式估算：请求发出与收到响应的本地时间取中点，认为服务器时间就是在这一刻生成的。
+    :return: (offset, rtt) 本地时间减去京东时间的差值与往返耗时，单位毫秒
+    """
+    get = session.get if session is not None else requests.get
+    send_time = time.time()
+    send_counter = time.perf_counter()
+    ret = get(JD_TIME_URL, timeout=timeout).text
+    rtt = (time.perf_counter() - send_counter) * 1000
+    server_time = int(json.loads(ret)["serverTime"])
+    # 往返耗时用单调时钟计算，避免采样期间本地时间被调整
+    return send_time * 1000 + rtt / 2 - server_time, rtt
+
+
+class ClockSync(object):
+    """多次采样同步京东服务器时间，并补偿网络往返耗时
+
+    每个样本给出一个区间 [offset - rtt/2, offset + rtt/2]，真实时间差必然落在其中。
+    先按中位数绝对偏差剔除离群样本，再取往返耗时最小的若干样本求区间交集，
+    交集的中点作为时间差，交集的半宽作为误差上界。
+    """
+
+    def __init__(self, samples=8, best=3, interval=0.05, session=None):
+        self.samples = max(int(samples), 1)
+        self.best = max(min(int(best), self.samples), 1)
+        self.interval = interval
+        # 复用同一个长连接采样，只有第一个样本包含握手耗时，会在筛选时被剔除
+        self.session = session if session is not None else TracedSession()
+
+        self.offset = None
+        self.error = None
+        self.rtt = None
+
+    def collect(self):
+        results = []
+        for i in range(self.samples):
+            try:
+                results.append(jd_time_sample(self.session))
+            except Exception as e:
+                logger.error('京东服务器时间采样失败: %s', e)
+            if i < self.samples - 1:
+                time.sleep(self.interval)
+        return results
+
+    def sync(self):
+        """执行一次同步
+        :return: (offset, error) 本地时间减去京东时间的差值及其误差上界，单位毫秒
+        """
+        results = self.collect()
+        if not results:
+            raise AsstException('无法获取京东服务器时间')
+
+        self.offset, self.error, self.rtt = self.estimate(results)
+        logger.info('京东服务器时间同步完成：有效样本%s个，时间误差【%.1f ± %.1f】毫秒，最小往返耗时%.1f毫秒',
+                    len(results), self.offset, self.error, self.rtt)
+        return self.offset, self.error
+
+    def estimate(self, results):
+        offsets = sorted(offset for offset, _ in results)
+        median = offsets[len(offsets) // 2]
+        mad = sorted(abs(offset - median) for offset in offsets)[len(offsets) // 2]
+        # 服务器时间精度为1毫秒，给离群阈值留出下限
+        threshold = max(3 * mad, 1.0)
+        kept = [(offset, rtt) for offset, rtt in results if abs(offset - median) <= threshold] or results
+
+        selected = sorted(kept, key=lambda x: x[1])[:self.best]
+        low = max(offset - rtt / 2 for offset, rtt in selected)
+        high = min(offset + rtt / 2 for offset, rtt in selected)
+        if low <= high:
+            offset = (low + high) / 2
+            error = (high - low) / 2
+        else:
+            # 区间不相交说明样本间存在抖动，退化为取均值，误差取最大半程往返耗时
+            offset = sum(offset for offset, _ in selected) / len(selected)
+            error = max(rtt / 2 for _, rtt in selected)
+        return offset, error, selected[0][1]
+
+
 def local_jd_time_diff():
-    return local_time() - jd_time()
+    return ClockSync().sync()[0]
+
+
+class ClockDrift(object):
+    """时间差历史记录与漂移率估计
+
+    历史记录保存在定长环形缓冲区中，漂移率为按误差加权的时间差对本地时间的最小二乘斜率。
+    """
+
+    def __init__(self, size=32):
+        self.history = deque(maxlen=size)
+
+    def add(self, offset, error, local_ms=None):
+        if local_ms is None:
+            local_ms = time.time() * 1000
+        self.history.append((local_ms, offset, error))
+
+    def rate(self):
+        """漂移率，单位为毫秒/毫秒；样本不足时为 0"""
+        if len(self.history) < 2:
+            return 0.0
+        weights = [1 / max(error, 0.5) ** 2 for _, _, error in self.history]
+        total = sum(weights)
+        mean_t = sum(w * t for w, (t, _, _) in zip(weights, self.history)) / total
+        mean_o = sum(w * o for w, (_, o, _) in zip(weights, self.history)) / total
+        var = sum(w * (t - mean_t) ** 2 for w, (t, _, _) in zip(weights, self.history))
+        if var == 0:
+            return 0.0
+        cov = sum(w * (t - mean_t) * (o - mean_o) for w, (t, o, _) in zip(weights, self.history))
+        return cov / var
+
+    def predict(self, local_ms=None):
+        """按漂移率外推指定本地时间的时间差"""
+        if local_ms is None:
+            local_ms = time.time() * 1000
+        last_ms, last_offset, _ = self.history[-1]
+        return last_offset + self.rate() * (local_ms - last_ms)
 
 
 class Timer(object):
-    def __init__(self, sleep_interval=0.5):
-        # '2018-09-28 22:45:50.000'
-        # buy_time = 2020-12-22 09:59:59.500
-        localtime = time.localtime(time.time())
-        buy_time_everyday = global_config.getRaw('product', 'buy_time').__str__()
-        last_purchase_time_everyday = global_config.getRaw('product', 'last_purchase_time').__str__()
-
-        # 最后购买时间
-        last_purchase_time = datetime.strptime(
-            localtime.tm_year.__str__() + '-' + localtime.tm_mon.__str__() + '-' + localtime.tm_mday.__str__() + ' ' + last_purchase_time_everyday,
-            "%Y-%m-%d %H:%M:%S.%f")
-
-        buy_time_config = datetime.strptime(
-            localtime.tm_year.__str__() + '-' + localtime.tm_mon.__str__() + '-' + localtime.tm_mday.__str__() + ' ' + buy_time_everyday,
-            "%Y-%m-%d %H:%M:%S.%f")
-
-        if time.mktime(localtime) < time.mktime(buy_time_config.timetuple()):
-            # 取正确的购买时间
-            self.buy_time = buy_time_config
-        # elif time.mktime(localtime) > time.mktime(last_purchase_time.timetuple()):
-        #     # 取明天的时间 购买时间
-        #     self.buy_time = datetime.strptime(
-        #         localtime.tm_year.__str__() + '-' + localtime.tm_mon.__str__() + '-' + (
-        #                 localtime.tm_mday + 1).__str__() + ' ' + buy_time_everyday,
-        #         "%Y-%m-%d %H:%M:%S.%f")
-        else:
-            self.buy_time = datetime.strptime(
-                localtime.tm_year.__str__() + '-' + localtime.tm_mon.__str__() + '-' + (
-                        localtime.tm_mday + 1).__str__() + ' ' + buy_time_everyday,
-                "%Y-%m-%d %H:%M:%S.%f")
+    # 后台重新同步时间的计划：(距离触发时间小于多少秒, 同步间隔秒数)，越接近触发时间同步越频繁
+    RESYNC_SCHEDULE = ((300, 30), (1800, 120))
+    RESYNC_INTERVAL = 600
+    # 临近触发时不再同步，避免与抢购请求争抢网络
+    RESYNC_QUIET = 5
+
+    def __init__(self, sleep_interval=0.5, clock_sync=None, coarse_margin=0.05, spin_threshold=0.002, session=None,
+                 settings=None):
+        self.settings = settings or get_settings()
+        # 构造时不访问网络，start 前或启动检查时再同步
+        self.diff_time, self.diff_error = 0, None
+        self.arm()
+        # 距离触发时间超过 coarse_margin 时按 sleep_interval 粗粒度休眠，
+        # 之后改为 1 毫秒的短休眠，最后 spin_threshold 内忙等
+        self.sleep_interval = sleep_interval
+        self.coarse_margin_ms = coarse_margin * 1000
+        self.spin_threshold_ms = spin_threshold * 1000
+        self.lateness = None
+
+        if clock_sync is None:
+            clock_sync = ClockSync(samples=self.settings.sync_samples, best=self.settings.sync_best_samples,
+                                   session=session)
+        self.clock_sync = clock_sync
+        self.drift = ClockDrift()
+        self.resync_enable = self.settings.clock_resync
+        self._resync_stop = None
+
+    def arm(self, now=None):
+        """按每天的购买时间与最后购买时间设定下一个抢购窗口
+        当前已处于窗口内时购买时间取当天，立即触发；已过最后购买时间则顺延到下一天。
+        最后购买时间早于购买时间时视为跨过零点，属于第二天。
+        当前时间使用校正后的京东服务器时间，与 deadline_remaining_ms 保持一致，
+        避免本地时钟偏慢时刚结束的窗口被重新设定。
+        """
+        now = now or datetime.fromtimestamp((time.time() * 1000 - self.diff_time) / 1000)
+        buy_clock = datetime.strptime(self.settings.buy_time, '%H:%M:%S.%f').time()
+        last_clock = datetime.strptime(self.settings.last_purchase_time, '%H:%M:%S.%f').time()
+        # 从前一天开始找，跨零点的窗口可能是前一天开始的
+        buy_time = datetime.combine(now.date() - timedelta(days=1), buy_clock)
+        last_purchase_time = datetime.combine(buy_time.date(), last_clock)
+        if last_purchase_time <= buy_time:
+            last_purchase_time += timedelta(days=1)
+        while now >= last_purchase_time:
+            buy_time += timedelta(days=1)
+            last_purchase_time += timedelta(days=1)
 
-        # self.buy_time = buy_time_config
+        self.set_buy_time(buy_time)
+        self.last_purchase_time = last_purchase_time
+        self.deadline_ms = self.to_ms(last_purchase_time)
+
+    @staticmethod
+    def to_ms(value):
+        return int(time.mktime(value.timetuple()) * 1000.0 + value.microsecond / 1000)
+
+    def set_buy_time(self, buy_time):
+        self.buy_time = buy_time
         print("购买时间：{}".format(self.buy_time))
+        self.buy_time_ms = self.to_ms(buy_time)
 
-        self.buy_time_ms = int(time.mktime(self.buy_time.timetuple()) * 1000.0 + self.buy_time.microsecond / 1000)
-        self.sleep_interval = sleep_interval
+    def __getstate__(self):
+        # 线程对象无法序列化，进程池中的副本各自重新启动后台同步
+        state = self.__dict__.copy()
+        state['_resync_stop'] = None
+        return state
 
-        self.diff_time = local_jd_time_diff()
+    @property
+    def synced(self):
+        return len(self.drift.history) > 0
+
+    def sync(self):
+        """首次同步京东服务器时间"""
+        self.diff_time, self.diff_error = self.clock_sync.sync()
+        self.drift.add(self.diff_time, self.diff_error)
 
     def start(self):
-        logger.info('正在等待到达设定时间:{}，检测本地时间与京东服务器时间误差为【{}】毫秒'.format(self.buy_time, self.diff_time))
+        if not self.synced:
+            self.sync()
+        logger.info('正在等待到达设定时间:{}，检测本地时间与京东服务器时间误差为【{:.1f} ± {:.1f}】毫秒'.format(
+            self.buy_time, self.diff_time, self.diff_error))
+        if self.resync_enable:
+            self.start_resync()
+        try:
+            with tracer.span('timer_wait', buy_time_ms=self.buy_time_ms) as span:
+                self.lateness = self.wait()
+                span.set(lateness_ms=self.lateness, diff_time=self.diff_time, diff_error=self.diff_error)
+        finally:
+            self.stop_resync()
+        logger.info('时间到达，开始执行……实际触发延迟【%.3f】毫秒，使用的时间误差【%.1f】毫秒，漂移率【%.2f】ppm',
+                    self.lateness, self.diff_time, self.drift.rate() * 1000000)
+        return self.lateness
+
+    def resync_interval(self, remaining):
+        for threshold, interval in self.RESYNC_SCHEDULE:
+            if remaining < threshold:
+                return interval
+        return self.RESYNC_INTERVAL
+
+    def resync(self):
+        offset, error = self.clock_sync.sync()
+        self.drift.add(offset, error)
+        self.diff_error = error
+        # 以最近一次同步为基准按漂移率外推，触发前由 wait 不断刷新
+        self.diff_time = self.drift.predict()
+
+    def start_resync(self):
+        if self._resync_stop is not None:
+            return
+        self._resync_stop = threading.Event()
+        thread = threading.Thread(target=self._resync_loop, args=(self._resync_stop,),
+                                  name='clock-resync', daemon=True)
+        thread.start()
+
+    def stop_resync(self):
+        if self._resync_stop is not None:
+            self._resync_stop.set()
+            self._resync_stop = None
+
+    def _resync_loop(self, stop):
+        while True:
+            remaining = self.remaining_ms() / 1000
+            interval = self.resync_interval(remaining)
+            if remaining - interval < self.RESYNC_QUIET:
+                return
+            if stop.wait(interval):
+                return
+            try:
+                self.resync()
+            except Exception as e:
+                logger.error('重新同步京东服务器时间失败: %s', e)
+
+    def remaining_ms(self):
+        """距离触发时间的毫秒数
+        本地时间减去与京东的时间差即为京东服务器时间，具体精度依赖时间同步的误差
+        """
+        now = time.time() * 1000
+        if len(self.drift.history) > 1:
+            self.diff_time = self.drift.predict(now)
+        return self.buy_time_ms + self.diff_time - now
+
+    def deadline_remaining_ms(self):
+        """距离最后购买时间的毫秒数"""
+        return self.deadline_ms + self.diff_time - time.time() * 1000
+
+    def expired(self):
+        """是否已过最后购买时间，在下单循环中调用，只使用已有的时间差不重新估算"""
+        return time.time() * 1000 - self.diff_time >= self.deadline_ms
+
+    def wait(self):
+        """混合休眠/忙等调度器，阻塞到触发时间
+        :return: 实际触发时间比设定时间晚了多少毫秒
+        """
         while True:
-            # 本地时间减去与京东的时间差，能够将时间误差提升到0.1秒附近
-            # 具体精度依赖获取京东服务器时间的网络时间损耗
-            if local_time() - self.diff_time >= self.buy_time_ms:
-                logger.info('时间到达，开始执行……')
+            remaining = self.remaining_ms()
+            if remaining <= self.spin_threshold_ms:
                 break
+            if remaining > self.coarse_margin_ms:
+                # 每次醒来都重新计算剩余时间，避免长时间休眠累积误差
+                time.sleep(min(self.sleep_interval, (remaining - self.coarse_margin_ms) / 1000))
             else:
-                time.sleep(self.sleep_interval)
+                time.sleep(0.001)
+
+        # 最后几毫秒基于单调时钟忙等，不受系统调度精度影响
+        deadline = time.perf_counter_ns() + int(remaining * 1000000)
+        while time.perf_counter_ns() < deadline:
+            pass
+        return -self.remaining_ms()
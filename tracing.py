@@ -0,0 +1,199 @@
+# -*- coding:utf-8 -*-
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from log import logger
+
+# 按 URL 中的关键字识别请求所属阶段，未命中时使用 域名+路径
+PHASES = (
+    ('queryServerData', 'clock_sync'),
+    ('itemShowBtn', 'get_url'),
+    ('captcha.html', 'request_url'),
+    ('seckill.action', 'checkout_page'),
+    ('init.action', 'init_info'),
+    ('submitOrder.action', 'submit_order'),
+    ('youshouinfo.action', 'reserve'),
+    ('item.jd.com', 'sku_title'),
+    ('qr.m.jd.com/show', 'qr_show'),
+    ('qr.m.jd.com/check', 'qr_check'),
+    ('qrCodeTicketValidation', 'qr_validate'),
+    ('getUserInfoForMiniJd', 'user_info'),
+    ('order.jd.com/center/list.action', 'validate_cookies'),
+)
+
+_attempt = contextvars.ContextVar('attempt', default=None)
+_connection = threading.local()
+
+
+def url_phase(url):
+    for keyword, phase in PHASES:
+        if keyword in url:
+            return phase
+    return url.split('?', 1)[0].split('://', 1)[-1]
+
+
+def percentile(values, q):
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class Span(object):
+    __slots__ = ('phase', 'attempt', 'start', 'end', 'attrs')
+
+    def __init__(self, phase, attempt, attrs):
+        self.phase = phase
+        self.attempt = attempt
+        self.start = time.perf_counter_ns()
+        self.end = None
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def elapsed(self):
+        return (self.end - self.start) / 1000000
+
+    def to_dict(self):
+        record = {
+            'phase': self.phase,
+            'attempt': self.attempt,
+            'pid': os.getpid(),
+            'start_ns': self.start,
+            'end_ns': self.end,
+            'elapsed_ms': self.elapsed,
+        }
+        record.update(self.attrs)
+        return record
+
+
+class Tracer(object):
+    """抢购流程的耗时追踪
+
+    每个 HTTP 请求或自定义阶段记为一个 span，记录单调时钟起止时间及状态码、响应大小、
+    首字节耗时、新建连接时的 DNS/TCP/TLS 耗时等信息，并按一次抢购尝试（attempt）分组。
+    运行结束后可按阶段输出 P50/P95/P99 报告，或导出为 JSONL 文件。
+    """
+
+    def __init__(self, enable=True):
+        self.enable = enable
+        self.spans = []
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._patched = False
+
+    @contextlib.contextmanager
+    def attempt(self):
+        """将其中的 span 归入同一次抢购尝试"""
+        token = _attempt.set('{}-{}'.format(os.getpid(), next(self._counter)))
+        try:
+            yield
+        finally:
+            _attempt.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, phase, **attrs):
+        if not self.enable:
+            yield Span(phase, None, attrs)
+            return
+        span = Span(phase, _attempt.get(), attrs)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            span.end = time.perf_counter_ns()
+            with self._lock:
+                self.spans.append(span)
+
+    def install(self):
+        """统计新建连接的 DNS、TCP、TLS 耗时，结果暂存在线程中，由该线程正在进行的请求领取"""
+        if self._patched or not self.enable:
+            return
+        self._patched = True
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+
+        def timed(func, key):
+            def wrapper(*args, **kwargs):
+                begin = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings = getattr(_connection, 'timings', None)
+                    if timings is not None:
+                        timings[key] = timings.get(key, 0) + (time.perf_counter_ns() - begin) / 1000000
+            return wrapper
+
+        socket.getaddrinfo = timed(socket.getaddrinfo, 'dns_ms')
+        HTTPConnection._new_conn = timed(HTTPConnection._new_conn, 'connect_ms')
+        HTTPSConnection.connect = timed(HTTPSConnection.connect, 'tls_ms')
+
+    def trace_request(self, method, url, send):
+        with self.span(url_phase(url), method=method, url=url.split('?', 1)[0]) as span:
+            _connection.timings = dict()
+            try:
+                resp = send()
+            finally:
+                timings, _connection.timings = _connection.timings, None
+                if 'tls_ms' in timings:
+                    # HTTPSConnection.connect 包含了 TCP 连接，单独扣除
+                    timings['tls_ms'] -= timings.get('connect_ms', 0)
+                if 'connect_ms' in timings:
+                    timings['connect_ms'] -= timings.get('dns_ms', 0)
+                span.set(**timings)
+            span.set(status=resp.status_code, ttfb_ms=resp.elapsed.total_seconds() * 1000,
+                     size=len(resp._content) if resp._content else int(resp.headers.get('Content-Length', 0)))
+            return resp
+
+    def export(self, path):
+        with self._lock:
+            spans, self.spans = self.spans, []
+        if not spans:
+            return
+        with open(path, 'a', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + '\n')
+        logger.info('已导出%s条耗时记录到%s', len(spans), path)
+
+    def report(self, spans=None):
+        """输出各阶段耗时；不指定 spans 时报告并清空已记录的 span，常驻模式下每轮只报告本轮"""
+        if spans is None:
+            with self._lock:
+                spans, self.spans = self.spans, []
+            spans = [span.to_dict() for span in spans]
+        phases = dict()
+        for span in spans:
+            phases.setdefault(span['phase'], []).append(span['elapsed_ms'])
+        for phase, values in phases.items():
+            values.sort()
+            logger.info('阶段[%s] 次数:%s P50:%.1fms P95:%.1fms P99:%.1fms 最大:%.1fms', phase, len(values),
+                        percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99), values[-1])
+
+    def report_file(self, path):
+        """汇总导出文件中的全部记录，可用于多进程模式"""
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            self.report([json.loads(line) for line in f if line.strip()])
+
+
+class TracedSession(requests.Session):
+    """所有请求都会记录到 tracer 的 session"""
+
+    def request(self, method, url, *args, **kwargs):
+        send = super().request
+        if not tracer.enable:
+            return send(method, url, *args, **kwargs)
+        return tracer.trace_request(method, url, lambda: send(method, url, *args, **kwargs))
+
+
+# 导入时不读取配置，由 JDWrapper 按 [trace] enable 开启
+tracer = Tracer(enable=False)
@@ -9,6 +9,22 @@ import time
 from log import logger
 from variables import USER_AGENTS
 
+try:
+    import orjson
+except ImportError:
+    # 可选依赖，安装后解析 JSON 更快
+    orjson = None
+
+try:
+    import brotli  # noqa: F401
+    # 可选依赖，安装后 urllib3 可以解压 br 编码的响应
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# 只需要响应头的请求，响应体不超过该字节数时读完原始字节后连接放回连接池，否则直接断开
+DISCARD_LIMIT = 16 * 1024
+
 
 def response_status(resp):
     if resp.status_code != requests.codes.OK:
@@ -43,12 +59,80 @@ def open_image(image_file):
             os.system("open " + image_file)  # for Mac
 
 
+def request_headers_only(session, method, url, **kwargs):
+    """只需要响应头的请求（设置 cookie、服务端状态），不下载和解码响应体
+
+    以流式方式发送，响应头到达时 cookie 已写入 session；之后不经解压直接丢弃响应体：
+    最多读取 DISCARD_LIMIT 字节原始数据（包括没有 Content-Length 的分块响应），
+    响应体在此之内结束时连接放回连接池复用，更大时才断开连接。
+    :return: 响应对象，不能再读取 content/text
+    """
+    kwargs.setdefault('allow_redirects', False)
+    resp = session.request(method, url, stream=True, **kwargs)
+    try:
+        body = resp.raw.read(DISCARD_LIMIT + 1, decode_content=False)
+    except Exception:
+        resp.close()
+        raise
+    if len(body) <= DISCARD_LIMIT:
+        resp.raw.release_conn()
+    else:
+        resp.close()
+    return resp
+
+
 def parse_json(s):
     begin = s.find('{')
     end = s.rfind('}') + 1
     return json.loads(s[begin:end])
 
 
+def parse_json_bytes(content):
+    """直接解析响应体 bytes 中的 JSON，兼容 jQueryNNN(...)、fetchJSON(...) 等 JSONP 包装
+    安装了 orjson 时通过 memoryview 切片解析，不复制数据；否则使用标准库 json
+    """
+    begin = content.find(b'{')
+    end = content.rfind(b'}') + 1
+    if orjson is not None:
+        return orjson.loads(memoryview(content)[begin:end])
+    return json.loads(content[begin:end])
+
+
+def parse_response(resp):
+    """解析响应中的 JSON/JSONP，跳过 resp.text 的解码及编码检测
+    响应体不是 UTF-8 编码时回退到按 resp.text 解析
+    """
+    try:
+        return parse_json_bytes(resp.content)
+    except ValueError:
+        return parse_json(resp.text)
+
+
+_field_patterns = dict()
+
+
+def parse_json_fields(content, fields):
+    """从响应体 bytes 中只提取需要判断的几个字段，不解析整个 JSON
+    只适用于字段名在响应中唯一的扁平结构，如提交订单、获取抢购链接的返回结果
+    :return: dict，响应中不存在的字段不会出现在结果中
+    """
+    result = dict()
+    for field in fields:
+        pattern = _field_patterns.get(field)
+        if pattern is None:
+            pattern = re.compile(rb'"' + field.encode() + rb'"\s*:\s*("(?:[^"\\]|\\.)*"|true|false|null|-?[\d.eE+-]+)')
+            _field_patterns[field] = pattern
+        match = pattern.search(content)
+        if match is None:
+            continue
+        value = match.group(1)
+        if value.startswith(b'"') and b'\\' not in value:
+            result[field] = value[1:-1].decode('utf-8', 'replace')
+        else:
+            result[field] = json.loads(value)
+    return result
+
+
 def check_login(func):
     """用户登陆态校验装饰器。若用户未登陆，则调用扫码登陆"""
     @functools.wraps(func)
@@ -61,11 +145,11 @@ def check_login(func):
     return new_func
 
 
-def parse_sku_id(sku_ids):
+def parse_sku_id(sku_ids, default_count='1'):
     """将商品id字符串解析为字典
 
-    商品id字符串采用英文逗号进行分割。
-    可以在每个id后面用冒号加上数字，代表该商品的数量，如果不加数量则默认为1。
+    商品id字符串采用英文逗号进行分割，字典保持原来的顺序。
+    可以在每个id后面用冒号加上数字，代表该商品的数量，如果不加数量则默认为 default_count。
 
     例如：
     输入  -->  解析结果
@@ -75,6 +159,7 @@ def parse_sku_id(sku_ids):
     '123456:2,123789' --> {'123456': '2', '123789': '1'}
 
     :param sku_ids: 商品id字符串
+    :param default_count: 没有指定数量时的数量
     :return: dict
     """
     if isinstance(sku_ids, dict):  # 防止重复解析
@@ -87,7 +172,7 @@ def parse_sku_id(sku_ids):
             sku_id, count = map(lambda x: x.strip(), item.split(':'))
             result[sku_id] = count
         else:
-            result[item] = '1'
+            result[item] = default_count
     return result
 
 